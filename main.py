@@ -1,24 +1,163 @@
 import threading
-from flask import Flask
+from flask import Flask, request, abort
 import os
 import logging
+import logging.handlers
 import psycopg2  # <-- المكتبة الجديدة
+import psycopg2.extras
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
 import shutil
 import asyncio
+import time
+import json
+import signal
+import sys
+import contextlib
+import io
+import csv
+import fcntl
+import atexit
+import queue
+import random
+import contextvars
+import functools
+from pathlib import Path
+import hashlib
+import hmac
+import mimetypes
+import multiprocessing
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+# مكتبات اختيارية: بدونها يتم تخطي الصور المصغرة وعدد صفحات PDF فقط
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
 
 # --- قراءة المتغيرات من بيئة الاستضافة ---
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
 DATABASE_URL = os.environ.get("DATABASE_URL")  # <-- متغير قاعدة البيانات الجديد
 SUPER_ADMIN_ID = int(os.environ.get("SUPER_ADMIN_ID", 0)) # يفضل قراءته من المتغيرات أيضاً
 FILES_DIR = "files"
+THUMBS_DIR = "thumbs"
+# عند ضبطه (مثال: https://my-bot.example.com) يعمل البوت بوضع webhook مع حالة مشتركة بين عدة نسخ
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+MULTI_REPLICA = bool(WEBHOOK_URL)
+if MULTI_REPLICA and not WEBHOOK_SECRET and TOKEN:
+    # سر مشتق من التوكن: متطابق في كل النسخ دون إعداد إضافي، ولا يعرفه من لا يملك التوكن
+    WEBHOOK_SECRET = hashlib.sha256(f"webhook-secret:{TOKEN}".encode()).hexdigest()
+JOB_UPLOAD_THRESHOLD = int(os.environ.get("JOB_UPLOAD_THRESHOLD", 5 * 1024 * 1024))  # بالبايت
+
+# عند ضبط BOT_API_URL (مثال: http://localhost:8081) يعمل البوت مع خادم Bot API محلي يشغَّل بالخيار --local:
+# الملفات المستلمة تُنقل من قرص الخادم مباشرة، والملفات المرسلة تُمرر كمسارات محلية بدلاً من رفع محتواها.
+BOT_API_URL = os.environ.get("BOT_API_URL", "").rstrip("/")
+LOCAL_BOT_API = bool(BOT_API_URL)
+# الحد الأقصى لحجم الملف الذي يمكن للبوت تنزيله: 20MB في Bot API السحابي، و2000MB في الخادم المحلي
+MAX_DOWNLOAD_SIZE = (2000 if LOCAL_BOT_API else 20) * 1024 * 1024
 
 # --- إعداد السجلات ---
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
+# المعالجات تضع السجلات في طابور فقط، والكتابة الفعلية تتم في خيط QueueListener،
+# فلا تتعطل حلقة الأحداث عند بطء stdout أو مجمّع السجلات.
+# كل سطر كائن JSON يحمل سياق التحديث الحالي (update_id, user_id) والمعالج والمدة عند توفرها.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # json أو text
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 0.01))
+SLOW_HANDLER_MS = float(os.environ.get("SLOW_HANDLER_MS", 1000))
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+LOG_CONTEXT_FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms', 'job_id', 'job_kind')
+_log_context = contextvars.ContextVar('log_context', default={})
+
+class LogContextFilter(logging.Filter):
+    """تنسخ سياق التحديث الحالي إلى السجل في الخيط الذي أنشأه، قبل أن يعبر الطابور."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def setup_logging() -> None:
+    output = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    # يفرغ ما تبقى في الطابور عند الخروج (بما في ذلك sys.exit بعد SIGTERM)
+    atexit.register(listener.stop)
+
+def set_log_level(level: str) -> None:
+    """تغيّر مستوى السجلات أثناء التشغيل؛ تُستدعى من /loglevel ومن إشعارات النسخ الأخرى."""
+    if level in LOG_LEVELS:
+        logging.getLogger().setLevel(level)
+
+def sampled_debug() -> bool:
+    """للمسارات الساخنة: تسجيل DEBUG لنسبة LOG_DEBUG_SAMPLE_RATE من الاستدعاءات فقط."""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_DEBUG_SAMPLE_RATE
+
+def bind_log_handler(name: str) -> None:
+    _log_context.set({**_log_context.get(), 'handler': name})
+
+def logged_handler(func):
+    """
+    تغلف معالجاً عند تسجيله: كل سجل يصدر أثناءه يحمل اسمه في الحقل handler، وتُسجَّل مدته
+    دائماً إن كان بطيئاً (SLOW_HANDLER_MS) وبالعينة فقط إن لم يكن.
+    """
+    @functools.wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        token = _log_context.set({**_log_context.get(), 'handler': func.__name__})
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            # قد يكون المعالج حدد اسماً أدق (مسار الزر في handle_button_press)
+            handler_name = _log_context.get()['handler']
+            timing = {'duration_ms': round(elapsed_ms, 1)}
+            if elapsed_ms >= SLOW_HANDLER_MS:
+                logger.warning(f"Slow handler {handler_name}: {elapsed_ms:.0f}ms", extra=timing)
+            elif sampled_debug():
+                logger.debug(f"Handler {handler_name} finished in {elapsed_ms:.1f}ms", extra=timing)
+            _log_context.reset(token)
+    return wrapper
+
+async def bind_log_context(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """تربط update_id وuser_id بكل السجلات التي تصدر أثناء معالجة هذا التحديث."""
+    _log_context.set({
+        'update_id': update.update_id,
+        'user_id': update.effective_user.id if update.effective_user else None,
+    })
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # --- وظائف قاعدة البيانات (PostgreSQL) ---
@@ -34,6 +173,7 @@ def setup_database():
     if not os.path.exists(FILES_DIR):
         os.makedirs(FILES_DIR)
         logger.info(f"Created files directory: {FILES_DIR}")
+    os.makedirs(THUMBS_DIR, exist_ok=True)
 
     conn = None
     try:
@@ -62,6 +202,99 @@ def setup_database():
             FOREIGN KEY (uploaded_by) REFERENCES users(user_id) ON DELETE SET NULL
         )
         """)
+
+        cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)")
+
+        # عدادات التنزيل والمشاهدة لكل ملف، تُحدّث دفعة واحدة من الذاكرة (انظر flush_file_stats)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS file_stats (
+            file_id INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+            downloads BIGINT NOT NULL DEFAULT 0,
+            views BIGINT NOT NULL DEFAULT 0,
+            last_download TIMESTAMPTZ
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_stats_downloads ON file_stats (downloads DESC)")
+        # بيانات وصفية تُستخرج بعد الرفع في عملية منفصلة (انظر process_upload_metadata)
+        cursor.execute("""
+        ALTER TABLE files
+            ADD COLUMN IF NOT EXISTS mime_type TEXT,
+            ADD COLUMN IF NOT EXISTS content_hash TEXT,
+            ADD COLUMN IF NOT EXISTS page_count INTEGER,
+            ADD COLUMN IF NOT EXISTS thumbnail_path TEXT
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files (content_hash)")
+        # وقت تعديل الملف في مصدر الاستيراد؛ upload_date يبقى وقت دخوله إلى البوت (تعتمد عليه سياسات الاحتفاظ والأحدث)
+        cursor.execute("ALTER TABLE files ADD COLUMN IF NOT EXISTS source_mtime TIMESTAMPTZ")
+        # حالة المحادثة المشتركة بين النسخ في وضع webhook
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSONB NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'queued',
+            priority INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            chat_id BIGINT,
+            progress TEXT,
+            last_error TEXT,
+            locked_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMPTZ
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (priority DESC, run_after, id) WHERE status = 'queued'")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs (locked_at) WHERE status = 'running'")
+        # يسمح باستخدام الفهرس مع استعلامات LIKE 'prefix/%' على المسارات
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_path_pattern ON files (file_path text_pattern_ops)")
+        # حصة مخصصة لكل مستخدم (NULL = حصة دوره الافتراضية) وعدادات الاستهلاك المحدثة مع كل رفع وحذف
+        cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS quota_bytes BIGINT")
+        cursor.execute("SELECT to_regclass('storage_usage')")
+        usage_table_exists = cursor.fetchone()[0] is not None
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS storage_usage (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            bytes_used BIGINT NOT NULL DEFAULT 0,
+            file_count INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_storage_usage_bytes ON storage_usage (bytes_used DESC)")
+        # سياسات الاحتفاظ لكل مجلد؛ المفتاح الأجنبي يتبع المجلد عند نقله أو إعادة تسميته ويُحذف معه
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            folder_path TEXT PRIMARY KEY REFERENCES files(file_path) ON UPDATE CASCADE ON DELETE CASCADE,
+            max_age_days INTEGER,
+            keep_last INTEGER,
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_files_upload_date ON files (upload_date) WHERE is_folder = FALSE")
+        # مجاميع الاستخدام لكل ساعة؛ المفتاح (bucket, metric) يخدم استعلامات النطاق الزمني مباشرة
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS usage_rollups (
+            bucket TIMESTAMPTZ NOT NULL,
+            metric TEXT NOT NULL,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, metric)
+        )
+        """)
+        if not usage_table_exists:
+            # تعبئة أولية لمرة واحدة من الملفات الموجودة؛ بعدها تُحدّث العدادات تدريجياً فقط
+            cursor.execute("""
+                INSERT INTO storage_usage (user_id, bytes_used, file_count)
+                SELECT uploaded_by, COALESCE(SUM(size_bytes), 0), COUNT(*) FROM files
+                WHERE is_folder = FALSE AND uploaded_by IS NOT NULL GROUP BY uploaded_by
+            """)
         
         conn.commit()
         logger.info("PostgreSQL Database setup complete. Tables are ready.")
@@ -74,15 +307,32 @@ def setup_database():
 
 # --- وظائف مساعدة للتحقق من الصلاحيات ---
 
+# ترتيب الأدوار من الأدنى إلى الأعلى، يُستخدم لمقارنة الصلاحيات المطلوبة لكل زر
+ROLE_LEVELS = {'user': 0, 'uploader': 1, 'admin': 2, 'super_admin': 3}
+ROLE_CACHE_TTL = float(os.environ.get("ROLE_CACHE_TTL", 60))
+_role_cache = {}  # user_id -> (role, expires_at)
+
+def invalidate_role_cache(user_id: int = None) -> None:
+    """تمسح دور مستخدم واحد من الذاكرة المؤقتة، أو كل الأدوار إذا لم يُحدد مستخدم."""
+    if user_id is None:
+        _role_cache.clear()
+    else:
+        _role_cache.pop(user_id, None)
+
 def get_user_role(user_id: int) -> str:
-    """(نسخة PostgreSQL) تجلب دور المستخدم من قاعدة البيانات."""
+    """(نسخة PostgreSQL) تجلب دور المستخدم من قاعدة البيانات، مع ذاكرة مؤقتة قصيرة العمر."""
+    cached = _role_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
     conn = None
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("SELECT role FROM users WHERE user_id = %s", (user_id,))
         result = cursor.fetchone()
-        return result[0] if result else 'unregistered'
+        role = result[0] if result else 'unregistered'
+        _role_cache[user_id] = (role, time.monotonic() + ROLE_CACHE_TTL)
+        return role
     except Exception as e:
         logger.error(f"Database error in get_user_role: {e}")
         return 'error'
@@ -91,16 +341,1427 @@ def get_user_role(user_id: int) -> str:
             cursor.close()
             conn.close()
 
+def has_role_at_least(user_id: int, min_role: str) -> bool:
+    return ROLE_LEVELS.get(get_user_role(user_id), -1) >= ROLE_LEVELS[min_role]
+
 def is_super_admin(user_id: int) -> bool:
-    return get_user_role(user_id) == 'super_admin'
+    return has_role_at_least(user_id, 'super_admin')
 
 def is_admin_or_higher(user_id: int) -> bool:
-    role = get_user_role(user_id)
-    return role in ['admin', 'super_admin']
+    return has_role_at_least(user_id, 'admin')
 
 def is_uploader_or_higher(user_id: int) -> bool:
-    role = get_user_role(user_id)
-    return role in ['uploader', 'admin', 'super_admin']
+    return has_role_at_least(user_id, 'uploader')
+
+# --- عدادات التنزيل والمشاهدة (تُجمع في الذاكرة وتُكتب دفعة واحدة) ---
+
+STATS_FLUSH_INTERVAL = float(os.environ.get("STATS_FLUSH_INTERVAL", 30))
+RANKING_LIMIT = 10
+# العدادات مفهرسة بمعرّف الصف لا بالمسار: النقل وإعادة التسمية على أي نسخة لا يغيّران المعرّف،
+# فلا تضيع عدادات النسخ الأخرى التي لم تُفرَّغ بعد.
+_pending_downloads = Counter()  # files.id -> عدد التنزيلات منذ آخر تفريغ
+_pending_views = Counter()  # files.id -> عدد مرات الظهور في القوائم منذ آخر تفريغ
+
+def record_download(file_id: int) -> None:
+    _pending_downloads[file_id] += 1
+    record_usage('downloads')
+
+def record_views(file_ids) -> None:
+    _pending_views.update(file_ids)
+
+def like_prefix(folder_abs_path: str) -> str:
+    """تُرجع نمط LIKE يطابق كل ما بداخل المجلد، مع تهريب المحارف الخاصة في اسمه."""
+    escaped = folder_abs_path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.rstrip(os.sep) + os.sep + '%'
+
+def _write_file_stats(downloads: Counter, views: Counter) -> None:
+    """(تعمل في خيط منفصل) تضيف العدادات المتراكمة إلى file_stats في استعلام upsert واحد."""
+    rows = [(file_id, downloads.get(file_id, 0), views.get(file_id, 0)) for file_id in set(downloads) | set(views)]
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, """
+            INSERT INTO file_stats (file_id, downloads, views, last_download)
+            SELECT f.id, v.downloads, v.views, CASE WHEN v.downloads > 0 THEN NOW() END
+            FROM (VALUES %s) AS v(file_id, downloads, views)
+            JOIN files f ON f.id = v.file_id
+            ON CONFLICT (file_id) DO UPDATE SET
+                downloads = file_stats.downloads + EXCLUDED.downloads,
+                views = file_stats.views + EXCLUDED.views,
+                last_download = COALESCE(EXCLUDED.last_download, file_stats.last_download)
+        """, rows, page_size=1000)
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def flush_file_stats() -> None:
+    """تفرّغ العدادات المتراكمة إلى قاعدة البيانات دون حجب حلقة الأحداث؛ تُعاد إلى الذاكرة عند الفشل."""
+    global _pending_downloads, _pending_views
+    if not _pending_downloads and not _pending_views:
+        return
+    downloads, views = _pending_downloads, _pending_views
+    _pending_downloads, _pending_views = Counter(), Counter()
+    try:
+        await asyncio.to_thread(_write_file_stats, downloads, views)
+        logger.debug("Flushed stats for %d files", len(set(downloads) | set(views)))
+    except Exception as e:
+        logger.error(f"Failed to flush file stats, will retry: {e}")
+        _pending_downloads.update(downloads)
+        _pending_views.update(views)
+
+# --- مجاميع الاستخدام الزمنية (تُجمع في الذاكرة وتُضاف إلى usage_rollups دفعة واحدة) ---
+# مسارات الكتابة تزيد عداداً في الذاكرة لكل (ساعة، مقياس)، والتفريغ الدوري يضيفه إلى الصف المقابل،
+# فتقرأ لوحة الإدارة بضع مئات من الصفوف المجمعة بدلاً من مسح جداول files وusers.
+
+USAGE_METRICS = {
+    'uploads': "📤 الرفع",
+    'downloads': "📥 التنزيل",
+    'new_users': "👤 مستخدمون جدد",
+    'bytes_added': "💾 الحجم المضاف",
+}
+USAGE_REPORT_DAYS = 14
+USAGE_MAX_DAYS = 366
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+_pending_usage = Counter()  # (بداية الساعة UTC, metric) -> الزيادة منذ آخر تفريغ
+
+def _current_bucket() -> datetime:
+    return datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+def record_usage(metric: str, amount: int = 1) -> None:
+    if amount:
+        _pending_usage[(_current_bucket(), metric)] += amount
+
+def _write_usage_rollups(cursor, usage: Counter) -> None:
+    """تضيف الزيادات إلى usage_rollups ضمن معاملة المستدعي."""
+    psycopg2.extras.execute_values(cursor, """
+        INSERT INTO usage_rollups (bucket, metric, value) VALUES %s
+        ON CONFLICT (bucket, metric) DO UPDATE SET value = usage_rollups.value + EXCLUDED.value
+    """, [(bucket, metric, value) for (bucket, metric), value in usage.items()])
+
+def _flush_usage_rollups(usage: Counter) -> None:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        _write_usage_rollups(cursor, usage)
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def flush_usage_rollups() -> None:
+    global _pending_usage
+    if not _pending_usage:
+        return
+    usage, _pending_usage = _pending_usage, Counter()
+    try:
+        await asyncio.to_thread(_flush_usage_rollups, usage)
+    except Exception as e:
+        logger.error(f"Failed to flush usage rollups, will retry: {e}")
+        _pending_usage.update(usage)
+
+def _fetch_daily_usage(days: int) -> list:
+    """صف لكل يوم (UTC) من آخر `days` يوماً بقيم كل المقاييس، من استعلام نطاق واحد على usage_rollups."""
+    today = datetime.now(timezone.utc).date()
+    first_day = today - timedelta(days=days - 1)
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT (bucket AT TIME ZONE 'UTC')::date AS day, metric, SUM(value)
+            FROM usage_rollups WHERE bucket >= %s
+            GROUP BY 1, 2
+        """, (datetime(first_day.year, first_day.month, first_day.day, tzinfo=timezone.utc),))
+        totals = {(day, metric): value for day, metric, value in cursor.fetchall()}
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+    rows = []
+    for offset in range(days):
+        day = first_day + timedelta(days=offset)
+        rows.append((day, {metric: int(totals.get((day, metric), 0)) for metric in USAGE_METRICS}))
+    return rows
+
+def sparkline(values: list) -> str:
+    peak = max(values, default=0)
+    if not peak:
+        return SPARK_BARS[0] * len(values)
+    return ''.join(SPARK_BARS[round(value / peak * (len(SPARK_BARS) - 1))] for value in values)
+
+def render_usage_chart(rows: list) -> str:
+    lines = [f"📈 النشاط اليومي ({rows[0][0]} ← {rows[-1][0]}، UTC):"]
+    for metric, label in USAGE_METRICS.items():
+        values = [totals[metric] for _day, totals in rows]
+        fmt = format_size if metric == 'bytes_added' else str
+        lines.append(f"{label}: {sparkline(values)}\n   المجموع: {fmt(sum(values))}، اليوم: {fmt(values[-1])}")
+    return "\n".join(lines)
+
+def render_usage_csv(rows: list) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['day', *USAGE_METRICS])
+    for day, totals in rows:
+        writer.writerow([day.isoformat(), *(totals[metric] for metric in USAGE_METRICS)])
+    return buffer.getvalue().encode('utf-8')
+
+# --- تتبع آخر نشاط للمستخدمين (يُجمع في الذاكرة ويُكتب دفعة واحدة) ---
+
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 60))
+_pending_last_seen = {}  # user_id -> وقت آخر تحديث وصل منه
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """تسجل وقت آخر نشاط لكل مستخدم في الذاكرة فقط؛ لا تصل إلى قاعدة البيانات."""
+    if update.effective_user:
+        _pending_last_seen[update.effective_user.id] = datetime.now(timezone.utc)
+
+def _write_last_seen(last_seen: dict) -> None:
+    """(تعمل في خيط منفصل) تحدّث users.last_seen لكل المستخدمين المتراكمين في استعلام واحد."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(cursor, """
+            UPDATE users SET last_seen = v.seen_at
+            FROM (VALUES %s) AS v(user_id, seen_at)
+            WHERE users.user_id = v.user_id AND (users.last_seen IS NULL OR users.last_seen < v.seen_at)
+        """, list(last_seen.items()), page_size=1000)
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def flush_last_seen() -> None:
+    global _pending_last_seen
+    if not _pending_last_seen:
+        return
+    last_seen, _pending_last_seen = _pending_last_seen, {}
+    try:
+        await asyncio.to_thread(_write_last_seen, last_seen)
+    except Exception as e:
+        logger.error(f"Failed to flush last_seen, will retry: {e}")
+        for user_id, seen_at in last_seen.items():
+            if _pending_last_seen.get(user_id, seen_at) <= seen_at:
+                _pending_last_seen[user_id] = seen_at
+
+# --- استخراج البيانات الوصفية والصور المصغرة بعد الرفع (في عمليات منفصلة) ---
+
+METADATA_WORKERS = int(os.environ.get("METADATA_WORKERS", 1))
+THUMBNAIL_SIZE = 320
+_metadata_pool = None
+_metadata_tasks = set()
+
+_FILE_SIGNATURES = [
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'PK\x03\x04', 'application/zip'),
+]
+
+def sniff_mime_type(file_path: str, head: bytes) -> str:
+    """تحدد نوع الملف من أول بايتات فيه، وتعود إلى الامتداد عند عدم التعرف."""
+    guessed = mimetypes.guess_type(file_path)[0]
+    for signature, mime_type in _FILE_SIGNATURES:
+        if head.startswith(signature):
+            # ملفات Office الحديثة هي ZIP في الأصل، فنثق بالامتداد إن وُجد
+            return (guessed or mime_type) if mime_type == 'application/zip' else mime_type
+    if head[4:8] == b'ftyp':
+        return guessed or 'video/mp4'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return guessed or 'application/octet-stream'
+
+def extract_file_metadata(file_path: str, thumbs_dir: str) -> dict:
+    """(تعمل داخل عملية منفصلة) تحسب النوع والبصمة وعدد الصفحات، وتنشئ صورة مصغرة للصور."""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        head = f.read(64)
+        sha256.update(head)
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    content_hash = sha256.hexdigest()
+    mime_type = sniff_mime_type(file_path, head)
+
+    page_count = None
+    if mime_type == 'application/pdf' and PdfReader is not None:
+        try:
+            page_count = len(PdfReader(file_path).pages)
+        except Exception:
+            pass
+
+    thumbnail_path = None
+    if mime_type.startswith('image/') and Image is not None:
+        # الاسم مبني على البصمة، فالنسخ المكررة من نفس الصورة تتشارك صورة مصغرة واحدة
+        thumbnail_path = os.path.join(thumbs_dir, f"{content_hash}.jpg")
+        if not os.path.exists(thumbnail_path):
+            try:
+                with Image.open(file_path) as img:
+                    img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                    tmp_path = f"{thumbnail_path}.{os.getpid()}.tmp"
+                    img.convert('RGB').save(tmp_path, 'JPEG', quality=80)
+                    os.replace(tmp_path, thumbnail_path)
+            except Exception:
+                thumbnail_path = None
+
+    return {'mime_type': mime_type, 'content_hash': content_hash, 'page_count': page_count, 'thumbnail_path': thumbnail_path}
+
+def get_metadata_pool() -> ProcessPoolExecutor:
+    # spawn بدلاً من fork لأن العملية الرئيسية تشغّل عدة خيوط (Flask والبوت)
+    global _metadata_pool
+    if _metadata_pool is None:
+        _metadata_pool = ProcessPoolExecutor(max_workers=METADATA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _metadata_pool
+
+def shutdown_metadata_pool() -> None:
+    global _metadata_pool
+    if _metadata_pool is not None:
+        _metadata_pool.shutdown(wait=False, cancel_futures=True)
+        _metadata_pool = None
+
+def _save_file_metadata(file_id: int, metadata: dict) -> None:
+    # بالمعرّف لا بالمسار: قد يُنقل الملف أو تُعاد تسميته أثناء الاستخراج
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE files SET mime_type = %s, content_hash = %s, page_count = %s, thumbnail_path = %s WHERE id = %s",
+            (metadata['mime_type'], metadata['content_hash'], metadata['page_count'], metadata['thumbnail_path'], file_id)
+        )
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def process_upload_metadata(file_id: int, file_path: str) -> None:
+    """تشغّل الاستخراج في مجمع العمليات ثم تحفظ النتيجة، دون حجب حلقة الأحداث."""
+    loop = asyncio.get_running_loop()
+    try:
+        metadata = await loop.run_in_executor(get_metadata_pool(), extract_file_metadata, file_path, os.path.abspath(THUMBS_DIR))
+        await asyncio.to_thread(_save_file_metadata, file_id, metadata)
+        logger.debug("Stored metadata for %s: %s", file_path, metadata['mime_type'])
+    except Exception as e:
+        logger.error(f"Metadata extraction failed for {file_path}: {e}")
+
+def _track_metadata_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _metadata_tasks.add(task)
+    task.add_done_callback(_metadata_tasks.discard)
+    return task
+
+def schedule_metadata_extraction(file_id: int, file_path: str) -> asyncio.Task:
+    return _track_metadata_task(process_upload_metadata(file_id, file_path))
+
+def _fetch_files_missing_metadata(after_id: int, limit: int) -> list:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, file_path FROM files WHERE is_folder = FALSE AND content_hash IS NULL AND id > %s ORDER BY id LIMIT %s",
+            (after_id, limit)
+        )
+        return cursor.fetchall()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def backfill_file_metadata(batch_size: int = 500) -> None:
+    """
+    تعالج كل الملفات التي لم تُستخرج بياناتها بعد (إعادة تشغيل أثناء المعالجة، أو استيراد جماعي)،
+    دفعة بعد دفعة مرتبة بالمعرّف: تنتظر انتهاء الدفعة قبل جلب التالية، فلا تتراكم آلاف المهام في الذاكرة
+    ولا يُعاد جلب ملف فشل استخراجه. نسخة واحدة فقط تنفذها في كل مرة، فلا تُعالج نفس الملفات N مرة.
+    """
+    try:
+        lock_conn = await asyncio.to_thread(try_singleton_lock, 'metadata-backfill')
+    except Exception as e:
+        logger.error(f"Could not start metadata backfill: {e}")
+        return
+    if lock_conn is None:
+        return
+    try:
+        last_id = 0
+        while True:
+            try:
+                rows = await asyncio.to_thread(_fetch_files_missing_metadata, last_id, batch_size)
+            except Exception as e:
+                logger.error(f"Could not load files for metadata backfill: {e}")
+                return
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            tasks = [schedule_metadata_extraction(file_id, file_path) for file_id, file_path in rows if os.path.isfile(file_path)]
+            await asyncio.gather(*tasks)
+    finally:
+        await asyncio.to_thread(lock_conn.close)
+
+def schedule_metadata_backfill() -> None:
+    _track_metadata_task(backfill_file_metadata())
+
+# --- طابور المهام الدائم (جدول jobs في PostgreSQL) ---
+# العمليات الطويلة (البث، حذف المجلدات، الملفات الكبيرة) تُسجَّل كصفوف في jobs وتعود المعالجات فوراً.
+# عمال غير متزامنين يحجزون المهام بـ FOR UPDATE SKIP LOCKED، فتنجو المهام من إعادة التشغيل
+# ويمكن زيادة الإنتاجية بزيادة JOB_WORKERS.
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 5))
+JOB_LOCK_TIMEOUT = int(os.environ.get("JOB_LOCK_TIMEOUT", 900))  # ثوانٍ قبل اعتبار مهمة قيد التنفيذ عالقة
+JOB_PROGRESS_INTERVAL = 3.0
+_job_handlers = {}  # نوع المهمة -> async def handler(bot, payload, report) -> نص النتيجة
+_job_wakeup = None
+
+class PermanentJobError(Exception):
+    """خطأ لا تفيد معه إعادة المحاولة؛ تفشل المهمة فوراً ويصل نص الخطأ للمستخدم."""
+
+def job_handler(kind: str):
+    """تسجّل دالة كمنفذ لنوع من المهام."""
+    def register(func):
+        _job_handlers[kind] = func
+        return func
+    return register
+
+def enqueue_job(kind: str, payload: dict, chat_id: int = None, priority: int = 0, max_attempts: int = 3) -> int:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO jobs (kind, payload, chat_id, priority, max_attempts) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+            (kind, psycopg2.extras.Json(payload), chat_id, priority, max_attempts)
+        )
+        job_id = cursor.fetchone()[0]
+        conn.commit()
+        return job_id
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def submit_job(kind: str, payload: dict, chat_id: int = None, priority: int = 0, max_attempts: int = 3) -> int:
+    """تضيف مهمة إلى الطابور وتوقظ العمال المنتظرين؛ تُرجع رقم المهمة."""
+    job_id = await asyncio.to_thread(enqueue_job, kind, payload, chat_id, priority, max_attempts)
+    logger.info(f"Queued job #{job_id} ({kind}) with priority {priority}")
+    if _job_wakeup is not None:
+        _job_wakeup.set()
+    return job_id
+
+def _claim_job():
+    """تحجز أعلى مهمة جاهزة أولوية دون انتظار الأقفال التي يحملها عمال آخرون."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = NOW()
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE status = 'queued' AND run_after <= NOW()
+                ORDER BY priority DESC, run_after, id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, kind, payload, attempts, max_attempts, chat_id
+        """)
+        row = cursor.fetchone()
+        conn.commit()
+        if not row:
+            return None
+        return dict(zip(('id', 'kind', 'payload', 'attempts', 'max_attempts', 'chat_id'), row))
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+# كل تحديث لمهمة قيد التنفيذ مشروط بـ attempts الذي حجزها به العامل: إن أُعيدت للطابور وحجزها عامل آخر
+# فلن يكتب العامل القديم فوق حالتها.
+_JOB_OWNER_CONDITION = "id = %s AND attempts = %s AND status = 'running'"
+
+def _finish_job(job: dict, status: str, error: str = None, retry_delay: float = None, refund_attempt: bool = False) -> None:
+    """refund_attempt: لا تُحتسب هذه المحاولة (إيقاف البوت ليس فشلاً للمهمة)."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if retry_delay is not None:
+            cursor.execute(
+                "UPDATE jobs SET status = 'queued', run_after = NOW() + make_interval(secs => %s), last_error = %s, locked_at = NULL, "
+                f"attempts = attempts - %s WHERE {_JOB_OWNER_CONDITION}",
+                (retry_delay, error, int(refund_attempt), job['id'], job['attempts'])
+            )
+        else:
+            cursor.execute(
+                f"UPDATE jobs SET status = %s, last_error = %s, finished_at = NOW(), locked_at = NULL WHERE {_JOB_OWNER_CONDITION}",
+                (status, error, job['id'], job['attempts'])
+            )
+        if cursor.rowcount == 0:
+            logger.warning(f"Job #{job['id']} was taken over by another worker; not marking it {status}")
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def _save_job_progress(job: dict, progress: str, state: dict = None) -> None:
+    """تحفظ نص التقدم وتجدد locked_at، وتحفظ حالة الاستئناف في payload إن وُجدت."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if state is None:
+            cursor.execute(f"UPDATE jobs SET progress = %s, locked_at = NOW() WHERE {_JOB_OWNER_CONDITION}",
+                           (progress, job['id'], job['attempts']))
+        else:
+            cursor.execute(
+                f"UPDATE jobs SET progress = %s, locked_at = NOW(), payload = payload || jsonb_build_object('state', %s::jsonb) WHERE {_JOB_OWNER_CONDITION}",
+                (progress, psycopg2.extras.Json(state), job['id'], job['attempts'])
+            )
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def _touch_job(job: dict) -> None:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE jobs SET locked_at = NOW() WHERE {_JOB_OWNER_CONDITION}", (job['id'], job['attempts']))
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def _requeue_stale_jobs() -> int:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE jobs SET status = 'queued', locked_at = NULL WHERE status = 'running' AND locked_at < NOW() - make_interval(secs => %s)",
+            (JOB_LOCK_TIMEOUT,)
+        )
+        conn.commit()
+        return cursor.rowcount
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def requeue_stale_jobs() -> None:
+    """تعيد إلى الطابور المهام التي توقف عاملها (مثلاً بسبب انهيار العملية) دون تحديث تقدمها."""
+    count = await asyncio.to_thread(_requeue_stale_jobs)
+    if count:
+        logger.warning(f"Requeued {count} stale job(s)")
+
+async def _notify_job_chat(bot: telegram.Bot, job: dict, text: str) -> None:
+    if not job['chat_id']:
+        return
+    try:
+        await bot.send_message(chat_id=job['chat_id'], text=text)
+    except telegram.error.TelegramError as e:
+        logger.warning(f"Could not notify chat {job['chat_id']} about job #{job['id']}: {e}")
+
+def _make_progress_reporter(bot: telegram.Bot, job: dict):
+    """تُرجع دالة report(text, state=None, force=False) تحدّث رسالة حالة واحدة في محادثة الطالب."""
+    status = {'message_id': None, 'last_edit': 0.0}
+
+    async def report(text: str, state: dict = None, force: bool = False) -> None:
+        await asyncio.to_thread(_save_job_progress, job, text, state)
+        if not job['chat_id']:
+            return
+        now = time.monotonic()
+        if not force and now - status['last_edit'] < JOB_PROGRESS_INTERVAL:
+            return
+        status['last_edit'] = now
+        full_text = f"⏳ مهمة #{job['id']}: {text}"
+        try:
+            if status['message_id'] is None:
+                message = await bot.send_message(chat_id=job['chat_id'], text=full_text)
+                status['message_id'] = message.message_id
+            else:
+                await bot.edit_message_text(full_text, chat_id=job['chat_id'], message_id=status['message_id'])
+        except telegram.error.TelegramError as e:
+            logger.debug("Progress update for job %s failed: %s", job['id'], e)
+
+    return report
+
+async def _job_heartbeat(job: dict) -> None:
+    """تجدد locked_at طوال التنفيذ، فلا تُعتبر المهمة عالقة أثناء عمل طويل لا يستدعي report()."""
+    while True:
+        await asyncio.sleep(JOB_LOCK_TIMEOUT / 3)
+        try:
+            await asyncio.to_thread(_touch_job, job)
+        except Exception as e:
+            logger.warning(f"Heartbeat for job #{job['id']} failed: {e}")
+
+async def _run_job(bot: telegram.Bot, job: dict) -> None:
+    handler = _job_handlers.get(job['kind'])
+    if handler is None:
+        await asyncio.to_thread(_finish_job, job, 'failed', f"Unknown job kind: {job['kind']}")
+        return
+    if job['attempts'] > job['max_attempts']:
+        await asyncio.to_thread(_finish_job, job, 'failed', "Exceeded max attempts")
+        await _notify_job_chat(bot, job, f"❌ فشلت المهمة #{job['id']} بعد {job['max_attempts']} محاولات.")
+        return
+
+    _log_context.set({'job_id': job['id'], 'job_kind': job['kind']})
+    started = time.perf_counter()
+    heartbeat = asyncio.create_task(_job_heartbeat(job))
+    try:
+        result = await handler(bot, job['payload'], _make_progress_reporter(bot, job))
+    except asyncio.CancelledError:
+        # إيقاف البوت: نعيد المهمة للطابور فوراً دون احتساب المحاولة، بدلاً من انتظار JOB_LOCK_TIMEOUT
+        await asyncio.to_thread(_finish_job, job, 'queued', "Interrupted by shutdown", 0, refund_attempt=True)
+        raise
+    except PermanentJobError as e:
+        await asyncio.to_thread(_finish_job, job, 'failed', str(e))
+        await _notify_job_chat(bot, job, f"❌ فشلت المهمة #{job['id']}: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Job #{job['id']} ({job['kind']}) failed on attempt {job['attempts']}: {e}")
+        if job['attempts'] < job['max_attempts']:
+            await asyncio.to_thread(_finish_job, job, 'queued', str(e), 10 * 2 ** (job['attempts'] - 1))
+        else:
+            await asyncio.to_thread(_finish_job, job, 'failed', str(e))
+            await _notify_job_chat(bot, job, f"❌ فشلت المهمة #{job['id']} بعد {job['attempts']} محاولات.")
+        return
+    finally:
+        heartbeat.cancel()
+
+    await asyncio.to_thread(_finish_job, job, 'done')
+    elapsed = time.perf_counter() - started
+    logger.info(f"Job #{job['id']} ({job['kind']}) finished in {elapsed:.1f}s", extra={'duration_ms': round(elapsed * 1000, 1)})
+    if result:
+        await _notify_job_chat(bot, job, f"✅ {result}")
+
+async def job_worker(bot: telegram.Bot, worker_no: int) -> None:
+    """حلقة عامل واحد: يحجز مهمة وينفذها، أو ينتظر إشعاراً أو انتهاء مهلة الاستطلاع."""
+    while True:
+        try:
+            job = await asyncio.to_thread(_claim_job)
+        except Exception as e:
+            logger.error(f"Job worker {worker_no} could not claim a job: {e}")
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(_job_wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            _job_wakeup.clear()
+            continue
+        try:
+            await _run_job(bot, job)
+        except Exception as e:
+            # خطأ في قاعدة البيانات أثناء إنهاء المهمة لا يجب أن يوقف العامل؛ requeue_stale_jobs تعيدها لاحقاً
+            logger.error(f"Job worker {worker_no} failed while running job #{job['id']}: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+# --- التشغيل بعدة نسخ (Multi-replica) ---
+# عند ضبط WEBHOOK_URL تستقبل كل النسخ التحديثات عبر webhook خلف موازن الأحمال، وتتشارك:
+# - حالة المحادثة (user_data) في جدول bot_user_data بدلاً من ذاكرة العملية.
+# - إبطال الذاكرة المؤقتة عبر LISTEN/NOTIFY على القناة cache_invalidation.
+# - أقفال استشارية (advisory locks) تسلسل العمليات التي تعدّل شجرة المجلدات.
+# يجب أن يكون FILES_DIR قرصاً مشتركاً بين كل النسخ.
+
+CACHE_INVALIDATION_CHANNEL = "cache_invalidation"
+FOLDER_LOCK_TIMEOUT = os.environ.get("FOLDER_LOCK_TIMEOUT", "60s")
+_user_data_snapshots = {}  # user_id -> user_data كما حُمّل في بداية التحديث، لتجنب الكتابة إن لم يتغير
+_invalidation_handlers = {
+    'roles': lambda arg: invalidate_role_cache(int(arg) if arg else None),
+}
+
+def notify_cache_invalidation(cursor, scope: str, arg='') -> None:
+    """ترسل إشعار إبطال لكل النسخ؛ يُسلَّم عند commit المعاملة الحالية فقط."""
+    cursor.execute("SELECT pg_notify(%s, %s)", (CACHE_INVALIDATION_CHANNEL, f"{scope}:{arg}"))
+
+def apply_cache_invalidation(payload: str) -> None:
+    scope, _, arg = payload.partition(':')
+    handler = _invalidation_handlers.get(scope)
+    if handler:
+        handler(arg)
+
+async def listen_for_cache_invalidations() -> None:
+    """تستمع لإشعارات الإبطال من النسخ الأخرى دون خيط إضافي، وتعيد الاتصال عند انقطاعه."""
+    loop = asyncio.get_running_loop()
+    while True:
+        conn = None
+        try:
+            conn = await asyncio.to_thread(get_db_connection)
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {CACHE_INVALIDATION_CHANNEL}")
+            # ربما فاتتنا إشعارات أثناء الانقطاع، فنبدأ بذاكرة مؤقتة فارغة
+            for handler in _invalidation_handlers.values():
+                handler('')
+            ready = asyncio.Event()
+            loop.add_reader(conn.fileno(), ready.set)
+            try:
+                while True:
+                    await ready.wait()
+                    ready.clear()
+                    conn.poll()
+                    while conn.notifies:
+                        apply_cache_invalidation(conn.notifies.pop(0).payload)
+            finally:
+                loop.remove_reader(conn.fileno())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Cache invalidation listener failed, reconnecting: {e}")
+            await asyncio.sleep(5)
+        finally:
+            if conn:
+                conn.close()
+
+def _load_user_data(user_id: int) -> dict:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT data FROM bot_user_data WHERE user_id = %s", (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else {}
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def _save_user_data(user_id: int, data: dict) -> None:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO bot_user_data (user_id, data, updated_at) VALUES (%s, %s, NOW())
+            ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+        """, (user_id, psycopg2.extras.Json(data)))
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def load_shared_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(المجموعة -2) تستبدل user_data المحلية بالنسخة المشتركة قبل أي معالج آخر."""
+    if not update.effective_user:
+        return
+    user_id = update.effective_user.id
+    # لا لقطة = لا كتابة في save_shared_user_data، حتى لا تطغى نسخة محلية قديمة على المشتركة
+    _user_data_snapshots.pop(user_id, None)
+    try:
+        data = await asyncio.to_thread(_load_user_data, user_id)
+    except Exception as e:
+        logger.error(f"Could not load shared user_data for {user_id}, changes in this update will not be saved: {e}")
+        return
+    context.user_data.clear()
+    context.user_data.update(data)
+    _user_data_snapshots[user_id] = json.dumps(data, sort_keys=True)
+
+async def save_shared_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(المجموعة الأخيرة) تكتب user_data إلى قاعدة البيانات إذا غيّرها أحد المعالجات."""
+    if not update.effective_user:
+        return
+    user_id = update.effective_user.id
+    loaded_snapshot = _user_data_snapshots.pop(user_id, None)
+    if loaded_snapshot is None:
+        return
+    snapshot = json.dumps(dict(context.user_data), sort_keys=True)
+    if snapshot != loaded_snapshot:
+        await asyncio.to_thread(_save_user_data, user_id, dict(context.user_data))
+
+def _advisory_key(path: str) -> int:
+    return int.from_bytes(hashlib.blake2b(path.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+def try_singleton_lock(name: str):
+    """
+    قفل استشاري غير منتظر للمهام الدورية: نسخة واحدة فقط تنفذها في كل مرة.
+    يُرجع الاتصال الحامل للقفل (يُحرر بإغلاقه)، أو None إن كانت نسخة أخرى تنفذها.
+    """
+    conn = get_db_connection()
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute("SELECT pg_try_advisory_lock(%s)", (_advisory_key(name),))
+    if cursor.fetchone()[0]:
+        return conn
+    conn.close()
+    return None
+
+def _acquire_folder_lock(*paths: str, shared: bool = False):
+    """
+    قفل هرمي: قفل مشترك على كل مجلد أب بدءاً من الجذر، ثم قفل حصري على المسار نفسه.
+    هكذا لا يُحذف أو يُنقل مجلد أثناء الكتابة بداخله، بينما تعمل العمليات على مجلدات متجاورة بالتوازي.
+    الأقفال مرتبطة بالجلسة، فتُحرر تلقائياً بإغلاق الاتصال حتى لو انهارت العملية.
+    عدة مسارات (النقل) تُقفل على نفس الاتصال، فلا يتعارض قفل مسار مع قفل أحد آبائه المطلوب معه،
+    وتُؤخذ كل الأقفال بترتيب المسار (الأب قبل الابن) كما في القفل المفرد، فلا يحدث جمود بين العمليات.
+    shared=True يقفل المسارات نفسها قفلاً مشتركاً: يمنع حذفها أو نقلها فقط، وتستمر العمليات بداخلها.
+    """
+    root_abs_path = os.path.abspath(FILES_DIR)
+    exclusive = {}  # مسار -> True للقفل الحصري، False للمشترك
+    for path in paths:
+        ancestor = root_abs_path
+        exclusive.setdefault(ancestor, False)
+        for part in os.path.relpath(os.path.dirname(path), root_abs_path).split(os.sep):
+            # للجذر نفسه يكون relpath(dirname(root), root) هو '..'
+            if part and part not in ('.', '..'):
+                ancestor = os.path.join(ancestor, part)
+                exclusive.setdefault(ancestor, False)
+    for path in paths:
+        exclusive[path] = not shared
+    conn = get_db_connection()
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SET lock_timeout = %s", (FOLDER_LOCK_TIMEOUT,))
+        for lock_path in sorted(exclusive):
+            lock_function = "pg_advisory_lock" if exclusive[lock_path] else "pg_advisory_lock_shared"
+            cursor.execute(f"SELECT {lock_function}(%s)", (_advisory_key(lock_path),))
+        return conn
+    except Exception:
+        conn.close()
+        raise
+
+@contextlib.asynccontextmanager
+async def folder_lock(*paths: str):
+    """تسلسل العمليات التي تعدّل المسارات المعطاة عبر كل النسخ باستخدام أقفال PostgreSQL الاستشارية."""
+    conn = await asyncio.to_thread(_acquire_folder_lock, *(os.path.abspath(path) for path in paths))
+    try:
+        yield
+    finally:
+        await asyncio.to_thread(conn.close)
+
+# --- ذاكرة مؤقتة لشجرة المجلدات ---
+# قوائم التنقل (الإنشاء، الرفع، النقل) تحتاج كل المجلدات في كل ضغطة؛ نحتفظ بها في الذاكرة
+# ونبطلها عند أي تعديل على الشجرة (محلياً وعبر NOTIFY للنسخ الأخرى).
+
+FOLDER_TREE_TTL = float(os.environ.get("FOLDER_TREE_TTL", 300))
+_folder_tree_cache = {'folders': None, 'expires_at': 0.0}
+
+def invalidate_folder_tree(_arg='') -> None:
+    _folder_tree_cache['folders'] = None
+
+_invalidation_handlers['tree'] = invalidate_folder_tree
+_invalidation_handlers['loglevel'] = set_log_level
+
+def get_all_folders() -> list:
+    """تُرجع [(الاسم، المسار المطلق)] لكل المجلدات مرتبة بالاسم."""
+    folders = _folder_tree_cache['folders']
+    if folders is not None and _folder_tree_cache['expires_at'] > time.monotonic():
+        return folders
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT file_name, file_path FROM files WHERE is_folder = TRUE ORDER BY file_name")
+        folders = [(name, os.path.normpath(os.path.abspath(path))) for name, path in cursor.fetchall()]
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+    _folder_tree_cache['folders'] = folders
+    _folder_tree_cache['expires_at'] = time.monotonic() + FOLDER_TREE_TTL
+    return folders
+
+def get_subfolders(current_abs_path: str) -> list:
+    return [{'name': name, 'path': path} for name, path in get_all_folders() if os.path.dirname(path) == current_abs_path]
+
+# --- الاستيراد الجماعي لشجرة مجلدات موجودة ---
+# يمر على شجرة المصدر بالتوازي، ويعكسها داخل FILES_DIR بروابط صلبة أو reflink متى أمكن (نسخ فقط كحل أخير)،
+# ثم يحمّل البيانات الوصفية إلى files بأمر COPY على دفعات كبيرة.
+# العملية قابلة للإعادة: الملفات الموجودة بنفس الحجم تُتخطى، والصفوف الموجودة تُتجاهل بـ ON CONFLICT،
+# وكل دفعة تُثبت على حدة، فإعادة التشغيل بعد انقطاع تكمل من حيث توقفت.
+
+# إن ضُبط، لا يُسمح بالاستيراد إلا من داخله. الأمر /import في المحادثة لا يعمل دونه، والاستيراد من أي مسار لسطر الأوامر فقط
+IMPORT_SOURCE_ROOT = os.environ.get("IMPORT_SOURCE_ROOT")
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 5000))
+IMPORT_WORKERS = int(os.environ.get("IMPORT_WORKERS", 8))
+FICLONE = 0x40049409  # ioctl الخاص بـ reflink في Linux (btrfs/xfs)
+
+def _scan_directory(src_dir: str):
+    """تقرأ مجلداً واحداً: تُرجع المجلدات الفرعية و(المسار، الحجم، وقت التعديل) لكل ملف. الروابط الرمزية تُتجاهل."""
+    subdirs, files = [], []
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir():
+                subdirs.append((entry.path, entry.stat().st_mtime))
+            elif entry.is_file():
+                st = entry.stat()
+                files.append((entry.path, st.st_size, st.st_mtime))
+    return subdirs, files
+
+def walk_tree_parallel(source_root: str, workers: int):
+    """تولّد ('dir'|'file', المسار، الحجم، وقت التعديل)؛ كل مجلد يظهر قبل محتوياته."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_directory, source_root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, files = future.result()
+                for path, mtime in subdirs:
+                    yield 'dir', path, None, mtime
+                    pending.add(pool.submit(_scan_directory, path))
+                for path, size, mtime in files:
+                    yield 'file', path, size, mtime
+
+def _mirror_file(src: str, dst: str, size: int) -> str:
+    """تضع نسخة من src في dst بأرخص طريقة متاحة؛ تُرجع ما حدث."""
+    if os.path.exists(dst):
+        return 'skipped' if os.path.getsize(dst) == size else 'conflict'
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except OSError:
+        pass
+    # النسخ يتم إلى ملف مؤقت ثم rename، فلا يبقى ملف ناقص لو انقطعت العملية
+    tmp_path = f"{dst}.import-tmp"
+    try:
+        with open(src, 'rb') as src_file, open(tmp_path, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                result = 'cloned'
+            except OSError:
+                shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+                result = 'copied'
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+        return result
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+def _copy_field(value) -> str:
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def _copy_rows_into_files(cursor, rows: list, uploaded_by: int) -> int:
+    """تحمّل دفعة صفوف إلى جدول مؤقت بـ COPY ثم تنقلها إلى files متجاهلة الموجود مسبقاً."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(_copy_field(value) for value in row) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert("COPY import_staging (file_name, file_path, is_folder, size_bytes, source_mtime) FROM STDIN", buffer)
+    cursor.execute("""
+        WITH inserted AS (
+            INSERT INTO files (file_name, file_path, is_folder, size_bytes, uploaded_by, upload_date, source_mtime)
+            SELECT file_name, file_path, is_folder, size_bytes, %s, NOW(), source_mtime FROM import_staging
+            ON CONFLICT (file_path) DO NOTHING
+            RETURNING is_folder, size_bytes
+        )
+        SELECT COUNT(*), COALESCE(SUM(size_bytes) FILTER (WHERE NOT is_folder), 0), COUNT(*) FILTER (WHERE NOT is_folder)
+        FROM inserted
+    """, (uploaded_by,))
+    inserted, added_bytes, added_files = cursor.fetchone()
+    if uploaded_by is not None and added_files:
+        apply_storage_deltas(cursor, {uploaded_by: (added_bytes, added_files)})
+    if added_files:
+        bucket = _current_bucket()
+        _write_usage_rollups(cursor, Counter({(bucket, 'uploads'): added_files, (bucket, 'bytes_added'): int(added_bytes)}))
+    return inserted
+
+class ImportDestinationRemoved(Exception):
+    """حُذفت وجهة الاستيراد أو نُقلت أثناءه؛ إعادة المحاولة كانت ستعيد إنشاءها."""
+
+def import_directory_tree(source_root: str, dest_abs_path: str, uploaded_by: int = None, progress=None) -> Counter:
+    """
+    تستورد شجرة source_root إلى dest_abs_path (داخل FILES_DIR). تعمل بشكل متزامن، فتُستدعى من خيط أو من سطر الأوامر.
+    progress(counts) تُستدعى بعد كل دفعة.
+    الربط والنسخ يتمان دون قفل، ثم يُؤخذ قفل مشترك على الوجهة حول تسجيل الدفعة فقط: يكفي لمنع حذفها
+    أو نقلها، ولا يوقف الرفع والحذف والنقل بداخلها أثناء الاستيراد الطويل.
+    """
+    source_root = os.path.abspath(source_root)
+    root_abs_path = os.path.abspath(FILES_DIR)
+    counts = Counter()
+
+    def to_row(dst_path: str, is_folder: bool, size, mtime) -> tuple:
+        source_mtime = datetime.fromtimestamp(mtime, tz=timezone.utc).isoformat() if mtime else None
+        return (os.path.basename(dst_path), dst_path, is_folder, size, source_mtime)
+
+    # صفوف لمجلد الوجهة وكل آبائه، إن لم تكن مسجلة بعد
+    pending_dirs = []
+    path = dest_abs_path
+    while path != root_abs_path:
+        pending_dirs.append(('dir', path, None, None))
+        path = os.path.dirname(path)
+    pending_dirs.reverse()
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS import_staging (
+                file_name TEXT, file_path TEXT, is_folder BOOLEAN, size_bytes BIGINT, source_mtime TIMESTAMPTZ
+            ) ON COMMIT DELETE ROWS
+        """)
+        with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as link_pool:
+
+            def destination_removed() -> bool:
+                if dest_abs_path == root_abs_path:
+                    return False
+                cursor.execute("SELECT 1 FROM files WHERE file_path = %s AND is_folder = TRUE", (dest_abs_path,))
+                return cursor.fetchone() is None
+
+            def flush_batch(batch: list) -> None:
+                # الدفعة الأولى تنشئ الوجهة؛ إن حُذفت بين دفعتين نتوقف بدلاً من إعادة إنشائها بلا صفوف لآبائها
+                first_batch = not counts
+                if not first_batch and not os.path.isdir(dest_abs_path):
+                    raise ImportDestinationRemoved(f"Import destination was removed: {dest_abs_path}")
+                rows = []
+                file_jobs = []
+                for kind, dst_path, size, mtime, src_path in batch:
+                    if kind == 'dir':
+                        os.makedirs(dst_path, exist_ok=True)
+                        rows.append(to_row(dst_path, True, None, mtime))
+                    else:
+                        file_jobs.append((src_path, dst_path, size, mtime))
+                results = link_pool.map(lambda job: _mirror_file(job[0], job[1], job[2]), file_jobs)
+                for (src_path, dst_path, size, mtime), result in zip(file_jobs, results):
+                    counts[result] += 1
+                    if result != 'conflict':
+                        rows.append(to_row(dst_path, False, size, mtime))
+                    else:
+                        logger.warning(f"Import conflict, keeping existing file: {dst_path}")
+
+                lock_conn = _acquire_folder_lock(dest_abs_path, shared=True)
+                try:
+                    # قد تكون حُذفت أثناء النسخ؛ صف قاعدة البيانات هو المرجع لأن النسخ نفسه يعيد إنشاء المجلدات على القرص
+                    if not first_batch and destination_removed():
+                        raise ImportDestinationRemoved(f"Import destination was removed: {dest_abs_path}")
+                    if rows:
+                        counts['rows_inserted'] += _copy_rows_into_files(cursor, rows, uploaded_by)
+                    if any(row[2] for row in rows):
+                        notify_cache_invalidation(cursor, 'tree')
+                    conn.commit()
+                finally:
+                    lock_conn.close()
+                invalidate_folder_tree()
+                if progress:
+                    progress(counts)
+
+            batch = [(kind, path, size, mtime, None) for kind, path, size, mtime in pending_dirs]
+            for kind, src_path, size, mtime in walk_tree_parallel(source_root, IMPORT_WORKERS):
+                dst_path = os.path.join(dest_abs_path, os.path.relpath(src_path, source_root))
+                batch.append((kind, dst_path, size, mtime, src_path))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush_batch(batch)
+                    batch = []
+            flush_batch(batch)
+    finally:
+        conn.close()
+    logger.info(f"Imported {source_root} into {dest_abs_path}: {dict(counts)}")
+    return counts
+
+def validate_import_source(source_root: str) -> str:
+    source_root = os.path.abspath(source_root)
+    if not os.path.isdir(source_root):
+        raise ValueError(f"Source directory does not exist: {source_root}")
+    if IMPORT_SOURCE_ROOT:
+        allowed_root = os.path.abspath(IMPORT_SOURCE_ROOT)
+        if source_root != allowed_root and not source_root.startswith(allowed_root + os.sep):
+            raise ValueError(f"Source must be inside IMPORT_SOURCE_ROOT ({allowed_root})")
+    root_abs_path = os.path.abspath(FILES_DIR)
+    if source_root == root_abs_path or source_root.startswith(root_abs_path + os.sep):
+        raise ValueError("Source cannot be inside FILES_DIR")
+    return source_root
+
+def _format_import_counts(counts: Counter) -> str:
+    return (f"روابط: {counts['linked']}، reflink: {counts['cloned']}، نسخ: {counts['copied']}، "
+            f"موجود مسبقاً: {counts['skipped']}، تعارض: {counts['conflict']}، صفوف جديدة: {counts['rows_inserted']}")
+
+@job_handler('import')
+async def _job_import(bot: telegram.Bot, payload: dict, report) -> str:
+    loop = asyncio.get_running_loop()
+
+    def progress(counts: Counter) -> None:
+        asyncio.run_coroutine_threadsafe(report(_format_import_counts(counts)), loop)
+
+    try:
+        counts = await asyncio.to_thread(import_directory_tree, payload['source'], payload['destination'], payload.get('user_id'), progress)
+    except ImportDestinationRemoved:
+        raise PermanentJobError(f"حُذف مجلد الوجهة '{os.path.basename(payload['destination'])}' أثناء الاستيراد، فتم إيقافه.")
+    # الاستخراج للملفات المستوردة يستمر في الخلفية بعد انتهاء المهمة
+    schedule_metadata_backfill()
+    return f"اكتمل الاستيراد إلى '{os.path.basename(payload['destination']) or 'الجذر'}'. {_format_import_counts(counts)}"
+
+async def import_tree(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/import <مجلد_المصدر> [مسار_الوجهة_النسبي]: يجدول استيراد شجرة كاملة كمهمة في الخلفية."""
+    if not is_super_admin(update.effective_user.id): return
+    if not IMPORT_SOURCE_ROOT:
+        # بدونه يمكن ربط أي مسار مقروء على الخادم (مثل /etc) داخل FILES_DIR ثم تنزيله
+        await update.message.reply_text("الاستيراد من المحادثة معطل: اضبط IMPORT_SOURCE_ROOT أولاً، أو استخدم: python main.py import")
+        return
+    if not context.args:
+        await update.message.reply_text("الاستخدام: /import <مجلد_المصدر_على_الخادم> [مسار_الوجهة]")
+        return
+    try:
+        source_root = validate_import_source(context.args[0])
+        destination = resolve_relative_path(context.args[1] if len(context.args) > 1 else '.')
+    except ValueError as e:
+        await update.message.reply_text(f"لا يمكن الاستيراد: {e}")
+        return
+    job_id = await submit_job('import', {'source': source_root, 'destination': destination, 'user_id': update.effective_user.id},
+                              chat_id=update.effective_chat.id, max_attempts=5)
+    await update.message.reply_text(f"تمت جدولة الاستيراد كمهمة #{job_id}، وسيصلك التقدم هنا.")
+
+def run_import_cli(args: list) -> None:
+    """python main.py import <source_dir> [dest_relative_path]"""
+    if not args:
+        print("Usage: python main.py import <source_dir> [dest_relative_path]")
+        sys.exit(2)
+    setup_database()
+    source_root = validate_import_source(args[0])
+    destination = resolve_relative_path(args[1] if len(args) > 1 else '.')
+    import_directory_tree(source_root, destination, progress=lambda counts: logger.info(f"Import progress: {dict(counts)}"))
+
+# --- حصص التخزين لكل رافع ---
+# الاستهلاك محفوظ في storage_usage ويُحدّث بفروقات عند الرفع والحذف والاستيراد بدلاً من جمع جدول files.
+# الرفع يحجز حجمه من الحصة (UPDATE ذري مشروط) قبل بدء التنزيل، ويُعاد الحجز إذا فشل الحفظ.
+
+def _parse_role_quotas(spec: str) -> dict:
+    """'uploader=1024,admin=5120' -> {'uploader': bytes, ...}؛ الأدوار غير المذكورة بلا حد."""
+    quotas = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        role, _, megabytes = item.partition('=')
+        quotas[role.strip()] = int(megabytes) * 1024 * 1024
+    return quotas
+
+ROLE_QUOTAS = _parse_role_quotas(os.environ.get("ROLE_QUOTAS_MB", "uploader=1024,admin=5120"))
+MIN_FREE_DISK = int(os.environ.get("MIN_FREE_DISK_MB", 500)) * 1024 * 1024
+TOP_CONSUMERS_LIMIT = 10
+
+class StorageQuotaError(PermanentJobError):
+    """تجاوز حصة المستخدم أو امتلاء القرص؛ النص موجه للمستخدم مباشرة."""
+
+def format_size(size_bytes: int) -> str:
+    return f"{size_bytes / (1024 * 1024):.1f} MB"
+
+def check_disk_space(size_bytes: int) -> None:
+    if shutil.disk_usage(FILES_DIR).free - size_bytes < MIN_FREE_DISK:
+        raise StorageQuotaError("عذرًا، لا توجد مساحة كافية على الخادم حالياً. تواصل مع الإدارة.")
+
+def _user_quota(cursor, user_id: int):
+    """الحصة بالبايت: المخصصة للمستخدم إن وجدت، وإلا حصة دوره، وNone تعني بلا حد."""
+    cursor.execute("SELECT role, quota_bytes FROM users WHERE user_id = %s", (user_id,))
+    row = cursor.fetchone()
+    if not row:
+        return 0
+    role, quota_bytes = row
+    return quota_bytes if quota_bytes is not None else ROLE_QUOTAS.get(role)
+
+def _quota_exceeded_message(quota: int, used: int) -> str:
+    return f"عذرًا، تجاوزت حصة التخزين المسموحة لك ({format_size(quota)}، المستخدم منها {format_size(used)})."
+
+def check_storage_quota(user_id: int, size_bytes: int) -> None:
+    """فحص سريع دون حجز، لرفض الرفع فوراً قبل جدولته كمهمة."""
+    check_disk_space(size_bytes)
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        quota = _user_quota(cursor, user_id)
+        if quota is None:
+            return
+        cursor.execute("SELECT bytes_used FROM storage_usage WHERE user_id = %s", (user_id,))
+        row = cursor.fetchone()
+        used = row[0] if row else 0
+        if used + size_bytes > quota:
+            raise StorageQuotaError(_quota_exceeded_message(quota, used))
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def reserve_storage(user_id: int, size_bytes: int) -> None:
+    """تحجز size_bytes من حصة المستخدم ذرياً، فلا يتجاوزها رفعان متزامنان؛ ترفع StorageQuotaError عند التجاوز."""
+    check_disk_space(size_bytes)
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        quota = _user_quota(cursor, user_id)
+        cursor.execute("INSERT INTO storage_usage (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,))
+        cursor.execute("""
+            UPDATE storage_usage SET bytes_used = bytes_used + %s, file_count = file_count + 1
+            WHERE user_id = %s AND (%s::BIGINT IS NULL OR bytes_used + %s <= %s::BIGINT)
+            RETURNING bytes_used
+        """, (size_bytes, user_id, quota, size_bytes, quota))
+        if cursor.fetchone() is None:
+            conn.rollback()
+            cursor.execute("SELECT bytes_used FROM storage_usage WHERE user_id = %s", (user_id,))
+            row = cursor.fetchone()
+            raise StorageQuotaError(_quota_exceeded_message(quota, row[0] if row else 0))
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def apply_storage_deltas(cursor, deltas: dict) -> None:
+    """تطبق فروقات {user_id: (bytes, files)} على storage_usage ضمن معاملة المستدعي."""
+    values = [(user_id, int(size), int(files)) for user_id, (size, files) in deltas.items() if user_id is not None]
+    if not values:
+        return
+    psycopg2.extras.execute_values(
+        cursor,
+        "INSERT INTO storage_usage (user_id) SELECT v.user_id FROM (VALUES %s) AS v(user_id, bytes, files) "
+        "WHERE EXISTS (SELECT 1 FROM users WHERE users.user_id = v.user_id) ON CONFLICT (user_id) DO NOTHING",
+        values
+    )
+    psycopg2.extras.execute_values(cursor, """
+        UPDATE storage_usage SET bytes_used = GREATEST(storage_usage.bytes_used + v.bytes, 0),
+                                 file_count = GREATEST(storage_usage.file_count + v.files, 0)
+        FROM (VALUES %s) AS v(user_id, bytes, files)
+        WHERE storage_usage.user_id = v.user_id
+    """, values)
+
+def release_storage(user_id: int, size_bytes: int) -> None:
+    """تعيد حجزاً لم يكتمل رفعه."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        apply_storage_deltas(cursor, {user_id: (-size_bytes, -1)})
+        conn.commit()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def show_storage_usage(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(للأدمن) أكثر المستخدمين استهلاكاً للتخزين مع حصصهم والمساحة الحرة على القرص."""
+    if not is_admin_or_higher(update.effective_user.id): return
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT u.username, u.user_id, u.role, u.quota_bytes, s.bytes_used, s.file_count
+            FROM storage_usage s JOIN users u ON u.user_id = s.user_id
+            ORDER BY s.bytes_used DESC LIMIT %s
+        """, (TOP_CONSUMERS_LIMIT,))
+        rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"DB error in show_storage_usage: {e}")
+        rows = None
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+    if rows is None:
+        response_message = "حدث خطأ في قاعدة البيانات."
+    else:
+        disk = shutil.disk_usage(FILES_DIR)
+        lines = [f"💾 استهلاك التخزين (المساحة الحرة: {format_size(disk.free)} من {format_size(disk.total)}):"]
+        for i, (username, user_id, role, quota_bytes, bytes_used, file_count) in enumerate(rows, 1):
+            quota = quota_bytes if quota_bytes is not None else ROLE_QUOTAS.get(role)
+            quota_text = format_size(quota) if quota is not None else "بلا حد"
+            name = f"@{username}" if username else str(user_id)
+            lines.append(f"{i}. {name}: {format_size(bytes_used)} / {quota_text} ({file_count} ملف)")
+        if not rows:
+            lines.append("لا يوجد استهلاك مسجل بعد.")
+        response_message = "\n".join(lines)
+
+    if update.callback_query:
+        keyboard = [[InlineKeyboardButton("⬅️ العودة لأوامر الإدارة", callback_data="admin_menu")]]
+        await update.callback_query.edit_message_text(response_message, reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await update.message.reply_text(response_message)
+
+async def set_quota(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/setquota @username <MB|default>: حصة مخصصة لمستخدم، أو العودة لحصة دوره."""
+    if not is_super_admin(update.effective_user.id): return
+    if len(context.args) != 2 or not context.args[0].startswith('@') or not (context.args[1].isdigit() or context.args[1] == 'default'):
+        await update.message.reply_text("الاستخدام: /setquota @username <الحجم_بالميغابايت|default>")
+        return
+    target_username = context.args[0].lstrip('@')
+    quota_bytes = None if context.args[1] == 'default' else int(context.args[1]) * 1024 * 1024
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET quota_bytes = %s WHERE username = %s", (quota_bytes, target_username))
+        if cursor.rowcount > 0:
+            conn.commit()
+            quota_text = format_size(quota_bytes) if quota_bytes is not None else "حصة الدور الافتراضية"
+            await update.message.reply_text(f"تم ضبط حصة @{target_username} إلى: {quota_text}")
+        else:
+            await update.message.reply_text(f"المستخدم @{target_username} غير موجود.")
+    except Exception as e:
+        logger.error(f"DB error in set_quota: {e}")
+        await update.message.reply_text("حدث خطأ في قاعدة البيانات.")
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+# --- سياسات الاحتفاظ وحذف الملفات المنتهية ---
+# لكل مجلد حد أقصى لعمر الملفات (max_age_days) و/أو عدد أحدث الملفات المحتفظ بها (keep_last)،
+# وتنطبق السياسة على كل ما بداخل المجلد. عملية دورية تحذف الملفات المنتهية على دفعات صغيرة
+# عبر delete_item_logic نفسها، فتُحدَّث الصور المصغرة وحصص التخزين كما في الحذف اليدوي.
+
+RETENTION_SWEEP_INTERVAL = int(os.environ.get("RETENTION_SWEEP_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 100))
+RETENTION_BATCH_PAUSE = float(os.environ.get("RETENTION_BATCH_PAUSE", 2.0))  # ثوانٍ بين الدفعات
+_RETENTION_COLUMNS = {'age': 'max_age_days', 'keep': 'keep_last'}
+
+def _fetch_retention_policies() -> list:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT folder_path, max_age_days, keep_last FROM retention_policies ORDER BY folder_path")
+        return cursor.fetchall()
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+def _fetch_expired_files(folder_path: str, max_age_days: int, keep_last: int, limit: int) -> list:
+    """أقدم الملفات المخالفة لسياسة المجلد، بحد أقصى limit؛ يعتمد على فهرس upload_date."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        paths = []
+        if max_age_days is not None:
+            cursor.execute("""
+                SELECT file_path FROM files
+                WHERE is_folder = FALSE AND upload_date < NOW() - make_interval(days => %s) AND file_path LIKE %s
+                ORDER BY upload_date LIMIT %s
+            """, (max_age_days, like_prefix(folder_path), limit))
+            paths.extend(row[0] for row in cursor.fetchall())
+        if keep_last is not None and len(paths) < limit:
+            cursor.execute("""
+                SELECT file_path FROM files
+                WHERE is_folder = FALSE AND file_path LIKE %s
+                ORDER BY upload_date DESC, id DESC OFFSET %s LIMIT %s
+            """, (like_prefix(folder_path), keep_last, limit))
+            paths.extend(row[0] for row in cursor.fetchall())
+        return list(dict.fromkeys(paths))[:limit]
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def sweep_retention() -> None:
+    lock_conn = await asyncio.to_thread(try_singleton_lock, 'retention-sweeper')
+    if lock_conn is None:
+        return
+    try:
+        total_deleted = 0
+        for folder_path, max_age_days, keep_last in await asyncio.to_thread(_fetch_retention_policies):
+            while True:
+                batch = await asyncio.to_thread(_fetch_expired_files, folder_path, max_age_days, keep_last, RETENTION_BATCH_SIZE)
+                deleted = 0
+                for file_path in batch:
+                    success, message = await delete_item_logic(file_path)
+                    if success:
+                        deleted += 1
+                    else:
+                        logger.warning(f"Retention sweep could not delete {file_path}: {message}")
+                total_deleted += deleted
+                # نتوقف عند آخر دفعة، أو عند أي فشل حتى لا ندور على نفس الملفات
+                if len(batch) < RETENTION_BATCH_SIZE or deleted < len(batch):
+                    break
+                await asyncio.sleep(RETENTION_BATCH_PAUSE)
+        if total_deleted:
+            logger.info(f"Retention sweep deleted {total_deleted} expired files")
+    finally:
+        await asyncio.to_thread(lock_conn.close)
+
+def _format_retention_policy(max_age_days: int, keep_last: int) -> str:
+    rules = []
+    if max_age_days is not None:
+        rules.append(f"حذف ما هو أقدم من {max_age_days} يوم")
+    if keep_last is not None:
+        rules.append(f"الاحتفاظ بآخر {keep_last} ملف")
+    return "، ".join(rules)
+
+async def manage_retention(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    /retention: عرض السياسات.
+    /retention <مسار_المجلد> age <أيام> | keep <عدد> | off: ضبط سياسة مجلد أو إلغاؤها.
+    """
+    if not is_admin_or_higher(update.effective_user.id): return
+    root_abs_path = os.path.abspath(FILES_DIR)
+    args = context.args
+    if not args:
+        try:
+            policies = await asyncio.to_thread(_fetch_retention_policies)
+        except Exception as e:
+            logger.error(f"DB error in manage_retention: {e}")
+            await update.message.reply_text("حدث خطأ في قاعدة البيانات.")
+            return
+        if not policies:
+            await update.message.reply_text("لا توجد سياسات احتفاظ.\nالاستخدام: /retention <مسار_المجلد> age <أيام> | keep <عدد> | off")
+            return
+        lines = ["🗓️ سياسات الاحتفاظ:"]
+        lines.extend(f"- {os.path.relpath(path, root_abs_path)}: {_format_retention_policy(age, keep)}" for path, age, keep in policies)
+        await update.message.reply_text("\n".join(lines))
+        return
+
+    if args[-1] == 'off' and len(args) >= 2:
+        folder_arg, action, value = " ".join(args[:-1]), 'off', None
+    elif len(args) >= 3 and args[-2] in _RETENTION_COLUMNS and args[-1].isdigit() and int(args[-1]) > 0:
+        folder_arg, action, value = " ".join(args[:-2]), args[-2], int(args[-1])
+    else:
+        await update.message.reply_text("الاستخدام: /retention <مسار_المجلد> age <أيام> | keep <عدد> | off")
+        return
+    try:
+        folder_abs_path = resolve_relative_path(folder_arg)
+    except ValueError:
+        await update.message.reply_text("خطأ أمني: مسار غير صالح.")
+        return
+
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT is_folder FROM files WHERE file_path = %s", (folder_abs_path,))
+        result = cursor.fetchone()
+        if not result or not result[0]:
+            await update.message.reply_text(f"المجلد '{folder_arg}' غير موجود.")
+            return
+        if action == 'off':
+            cursor.execute("DELETE FROM retention_policies WHERE folder_path = %s", (folder_abs_path,))
+            conn.commit()
+            await update.message.reply_text(f"تم إلغاء سياسة الاحتفاظ للمجلد '{folder_arg}'.")
+            return
+        column = _RETENTION_COLUMNS[action]
+        cursor.execute(f"""
+            INSERT INTO retention_policies (folder_path, {column}) VALUES (%s, %s)
+            ON CONFLICT (folder_path) DO UPDATE SET {column} = EXCLUDED.{column}, updated_at = NOW()
+            RETURNING max_age_days, keep_last
+        """, (folder_abs_path, value))
+        max_age_days, keep_last = cursor.fetchone()
+        conn.commit()
+        await update.message.reply_text(
+            f"سياسة المجلد '{folder_arg}': {_format_retention_policy(max_age_days, keep_last)}.\n"
+            f"تُطبَّق خلال {RETENTION_SWEEP_INTERVAL // 60} دقيقة على الأكثر."
+        )
+    except Exception as e:
+        logger.error(f"DB error in manage_retention: {e}")
+        await update.message.reply_text("حدث خطأ في قاعدة البيانات.")
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
 
 # --- وظائف البوت الرئيسية (Handlers) ---
 
@@ -132,22 +1793,10 @@ async def show_folder_creation_menu(update: Update, context: ContextTypes.DEFAUL
     keyboard.append([InlineKeyboardButton("➕ إنشاء مجلد هنا", callback_data=f"create_here_{current_rel_path}")])
 
     subfolders = []
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_name, file_path FROM files WHERE is_folder = TRUE ORDER BY file_name")
-        all_folders_from_db = cursor.fetchall()
-        for name, path in all_folders_from_db:
-            folder_abs_path = os.path.normpath(os.path.abspath(path))
-            if os.path.dirname(folder_abs_path) == current_abs_path:
-                subfolders.append({'name': name, 'path': folder_abs_path})
+        subfolders = get_subfolders(current_abs_path)
     except Exception as e:
         logger.error(f"Error fetching subfolders from DB: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
 
     for folder in subfolders:
         folder_rel_path = os.path.relpath(folder['path'], root_abs_path)
@@ -179,9 +1828,10 @@ async def send_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     keyboard = [
         [InlineKeyboardButton("إنشاء مجلد جديد 📁", callback_data="admin_newfolder")],
-        [InlineKeyboardButton("حذف ملف/مجلد (تفاعلي) 🗑️", callback_data="admin_delete_start")],
+        [InlineKeyboardButton("إدارة الملفات (حذف/نقل/إعادة تسمية) 🗂️", callback_data="admin_delete_start")],
         [InlineKeyboardButton("رفع ملف 📤", callback_data="admin_upload_info")],
         [InlineKeyboardButton("عرض الإحصائيات 📊", callback_data="admin_stats_button")],
+        [InlineKeyboardButton("استهلاك التخزين 💾", callback_data="admin_usage_button")],
     ]
     if is_super_admin(user_id):
         keyboard.extend([
@@ -209,24 +1859,34 @@ async def send_admin_roles_menu(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
+    initial_role = 'super_admin' if user.id == SUPER_ADMIN_ID else 'user'
     conn = None
     try:
         conn = get_db_connection()
+        conn.autocommit = True  # استعلام واحد، فلا داعي لجولة COMMIT منفصلة
         cursor = conn.cursor()
-        cursor.execute("SELECT role FROM users WHERE user_id = %s", (user.id,))
-        if cursor.fetchone():
-            cursor.execute("UPDATE users SET username = %s WHERE user_id = %s", (user.username, user.id))
+        # تسجيل أو تحديث في جولة واحدة؛ xmax = 0 يعني أن الصف أُدرج للتو ولم يكن موجوداً
+        # pg_notify في نفس الاستعلام يُبطل الدور المخزن مؤقتاً لدى النسخ الأخرى دون جولة إضافية
+        cursor.execute("""
+            WITH upserted AS (
+                INSERT INTO users (user_id, username, role, last_seen) VALUES (%s, %s, %s, NOW())
+                ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, last_seen = NOW()
+                RETURNING (xmax = 0) AS inserted
+            )
+            SELECT inserted, pg_notify(%s, %s) FROM upserted
+        """, (user.id, user.username, initial_role, CACHE_INVALIDATION_CHANNEL, f"roles:{user.id}"))
+        inserted = cursor.fetchone()[0]
+        invalidate_role_cache(user.id)
+        if not inserted:
             logger.info(f"User {user.username} (ID: {user.id}) updated.")
             await update.message.reply_text(f'أهلاً بك مرة أخرى يا {user.first_name}! تم تحديث بياناتك.')
         else:
-            cursor.execute("INSERT INTO users (user_id, username, role) VALUES (%s, %s, %s)", (user.id, user.username, 'user'))
             logger.info(f"User {user.username} (ID: {user.id}) registered.")
+            record_usage('new_users')
             await update.message.reply_text(f'أهلاً بك يا {user.first_name}! تم تسجيلك بنجاح.')
-            if user.id == SUPER_ADMIN_ID:
-                cursor.execute("UPDATE users SET role = 'super_admin' WHERE user_id = %s", (SUPER_ADMIN_ID,))
+            if initial_role == 'super_admin':
                 logger.info(f"User {user.username} (ID: {user.id}) set as Super Admin.")
                 await update.message.reply_text("تم تعيينك كمدير أعلى (Super Admin)!")
-        conn.commit()
     except Exception as e:
         logger.error(f"Database error on start: {e}")
         await update.message.reply_text("حدث خطأ في قاعدة البيانات.")
@@ -239,6 +1899,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def text_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.user_data.get('user_action') == 'awaiting_new_folder_name':
         await handle_new_folder_creation(update, context)
+    elif context.user_data.get('user_action') == 'awaiting_rename':
+        await handle_rename(update, context)
     else:
         logger.info(f"Ignoring generic text message from {update.effective_user.id}.")
 
@@ -304,17 +1966,20 @@ async def handle_new_folder_creation(update: Update, context: ContextTypes.DEFAU
     full_path = os.path.abspath(os.path.join(parent_path, folder_name))
     conn = None
     try:
-        if os.path.exists(full_path):
-            await update.message.reply_text(f"المجلد '{folder_name}' موجود بالفعل.")
-        else:
-            os.makedirs(full_path)
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO files (file_name, file_path, is_folder, uploaded_by) VALUES (%s, %s, TRUE, %s)", (folder_name, full_path, user_id))
-            conn.commit()
-            await update.message.reply_text(f"✅ تم إنشاء المجلد '{folder_name}' بنجاح.")
-            status_message = await update.message.reply_text("جاري تحديث القائمة...")
-            await list_files_with_buttons(status_message, context, parent_path)
+        async with folder_lock(full_path):
+            if os.path.exists(full_path):
+                await update.message.reply_text(f"المجلد '{folder_name}' موجود بالفعل.")
+            else:
+                os.makedirs(full_path)
+                conn = get_db_connection()
+                cursor = conn.cursor()
+                cursor.execute("INSERT INTO files (file_name, file_path, is_folder, uploaded_by) VALUES (%s, %s, TRUE, %s)", (folder_name, full_path, user_id))
+                notify_cache_invalidation(cursor, 'tree')
+                conn.commit()
+                invalidate_folder_tree()
+                await update.message.reply_text(f"✅ تم إنشاء المجلد '{folder_name}' بنجاح.")
+                status_message = await update.message.reply_text("جاري تحديث القائمة...")
+                await list_files_with_buttons(status_message, context, parent_path)
     except Exception as e:
         logger.error(f"Error in handle_new_folder_creation: {e}")
         await update.message.reply_text("حدث خطأ أثناء إنشاء المجلد.")
@@ -325,15 +1990,30 @@ async def handle_new_folder_creation(update: Update, context: ContextTypes.DEFAU
         context.user_data.pop('user_action', None)
         context.user_data.pop('creation_path', None)
 
+def media_file_name(media) -> str:
+    """اسم الملف كما أرسله المستخدم، أو اسم من file_unique_id بامتداد يناسب نوع الوسائط (الصور والفيديو غالباً بلا اسم)."""
+    file_name = os.path.basename(getattr(media, 'file_name', None) or '')
+    if file_name:
+        return file_name
+    if isinstance(media, telegram.PhotoSize):
+        ext = '.jpg'
+    else:
+        mime_type = getattr(media, 'mime_type', None)
+        ext = (mimetypes.guess_extension(mime_type) if mime_type else None) or ('.mp4' if isinstance(media, telegram.Video) else '')
+    return f"{media.file_unique_id}{ext}"
+
 async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     if not is_uploader_or_higher(user_id):
         return
-    file_to_process = update.message.document or update.message.photo[-1] or update.message.video
+    file_to_process = update.message.document or (update.message.photo[-1] if update.message.photo else None) or update.message.video
     if not file_to_process: return
+    if file_to_process.file_size and file_to_process.file_size > MAX_DOWNLOAD_SIZE:
+        await update.message.reply_text(f"عذرًا، حجم الملف يتجاوز الحد المسموح ({MAX_DOWNLOAD_SIZE // (1024 * 1024)} MB).")
+        return
     context.user_data['pending_upload'] = {
         'file_id': file_to_process.file_id,
-        'file_name': getattr(file_to_process, 'file_name', f"{file_to_process.file_unique_id}.jpg"),
+        'file_name': media_file_name(file_to_process),
         'file_size': file_to_process.file_size,
     }
     logger.info(f"User {user_id} initiated upload. Awaiting destination.")
@@ -349,22 +2029,10 @@ async def show_upload_destination_menu(update: Update, context: ContextTypes.DEF
         keyboard.append([InlineKeyboardButton("✅ حدد هذا المجلد للحفظ هنا", callback_data=f"upload_to_{current_rel_path}")])
     
     subfolders = []
-    conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_name, file_path FROM files WHERE is_folder = TRUE ORDER BY file_name")
-        all_folders = cursor.fetchall()
-        for name, path in all_folders:
-            folder_abs_path = os.path.normpath(os.path.abspath(path))
-            if os.path.dirname(folder_abs_path) == current_abs_path:
-                subfolders.append({'name': name, 'path': folder_abs_path})
+        subfolders = get_subfolders(current_abs_path)
     except Exception as e:
         logger.error(f"DB error in show_upload_destination_menu: {e}")
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
 
     for folder in subfolders:
         folder_rel_path = os.path.relpath(folder['path'], root_abs_path)
@@ -390,39 +2058,183 @@ async def show_upload_destination_menu(update: Update, context: ContextTypes.DEF
     else:
         await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
 
+# فشل غير متوقع (قاعدة البيانات، مهلة القفل...) يستحق إعادة المحاولة، بخلاف المسار غير الصالح أو العنصر المحذوف مسبقاً
+DELETE_FAILED_MESSAGE = "حدث خطأ فادح أثناء عملية الحذف."
+
 async def delete_item_logic(item_path_to_delete: str) -> (bool, str):
     item_abs_path = os.path.abspath(item_path_to_delete)
     item_name = os.path.basename(item_abs_path)
-    if not item_abs_path.startswith(os.path.abspath(FILES_DIR)):
+    if not item_abs_path.startswith(os.path.abspath(FILES_DIR) + os.sep):
         logger.critical(f"Security alert: Attempted to delete path outside FILES_DIR: {item_abs_path}")
         return False, "خطأ أمني: المسار غير صالح."
     conn = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_folder FROM files WHERE file_path = %s", (item_abs_path,))
-        result = cursor.fetchone()
-        if not result:
-            return False, f"العنصر '{item_name}' غير موجود في قاعدة البيانات."
-        is_folder = bool(result[0])
-        if os.path.exists(item_abs_path):
-            if is_folder: shutil.rmtree(item_abs_path)
-            else: os.remove(item_abs_path)
-        cursor.execute("DELETE FROM files WHERE file_path = %s", (item_abs_path,))
+        async with folder_lock(item_abs_path):
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT is_folder FROM files WHERE file_path = %s", (item_abs_path,))
+            result = cursor.fetchone()
+            if not result:
+                return False, f"العنصر '{item_name}' غير موجود في قاعدة البيانات."
+            is_folder = bool(result[0])
+            if os.path.exists(item_abs_path):
+                if is_folder: await asyncio.to_thread(shutil.rmtree, item_abs_path)
+                else: os.remove(item_abs_path)
+            cursor.execute("DELETE FROM files WHERE file_path = %s RETURNING thumbnail_path, uploaded_by, size_bytes, is_folder", (item_abs_path,))
+            deleted_rows = cursor.fetchall()
+            if is_folder:
+                cursor.execute("DELETE FROM files WHERE file_path LIKE %s RETURNING thumbnail_path, uploaded_by, size_bytes, is_folder", (like_prefix(item_abs_path),))
+                deleted_rows.extend(cursor.fetchall())
+            thumbnails = {row[0] for row in deleted_rows if row[0]}
+            # خصم الملفات المحذوفة من استهلاك رافعيها
+            usage_deltas = {}
+            for _thumb, uploaded_by, size_bytes, row_is_folder in deleted_rows:
+                if uploaded_by is not None and not row_is_folder:
+                    freed_bytes, freed_files = usage_deltas.get(uploaded_by, (0, 0))
+                    usage_deltas[uploaded_by] = (freed_bytes - (size_bytes or 0), freed_files - 1)
+            apply_storage_deltas(cursor, usage_deltas)
+            if thumbnails:
+                # لا نحذف صورة مصغرة ما زال ملف مكرر آخر يستخدمها
+                cursor.execute("SELECT DISTINCT thumbnail_path FROM files WHERE thumbnail_path = ANY(%s)", (list(thumbnails),))
+                thumbnails.difference_update(row[0] for row in cursor.fetchall())
+            if is_folder:
+                notify_cache_invalidation(cursor, 'tree')
+            conn.commit()
+            if is_folder:
+                invalidate_folder_tree()
+            for thumbnail_path in thumbnails:
+                try:
+                    os.remove(thumbnail_path)
+                except OSError:
+                    pass
+            success_msg = f"تم حذف '{item_name}' بنجاح."
+            logger.info(success_msg)
+            return True, success_msg
+    except Exception as e:
+        logger.error(f"Error during deletion of {item_abs_path}: {e}")
+        return False, DELETE_FAILED_MESSAGE
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+async def move_item_logic(source_path: str, dest_parent_path: str, new_name: str = None) -> (bool, str):
+    """
+    تنقل أو تعيد تسمية ملف/مجلد: عملية rename واحدة على القرص، وUPDATE واحد يعيد كتابة
+    مسارات كل العناصر التابعة عبر فهرس البادئة، مهما كان عددها.
+    """
+    root_abs_path = os.path.abspath(FILES_DIR)
+    source_abs_path = os.path.abspath(source_path)
+    dest_parent_abs = os.path.abspath(dest_parent_path)
+    new_name = new_name or os.path.basename(source_abs_path)
+    target_abs_path = os.path.join(dest_parent_abs, new_name)
+    for path in (source_abs_path, target_abs_path):
+        if not path.startswith(root_abs_path + os.sep):
+            logger.critical(f"Security alert: Attempted to move path outside FILES_DIR: {path}")
+            return False, "خطأ أمني: المسار غير صالح."
+    if target_abs_path == source_abs_path:
+        return True, "لم يتغير شيء."
+    if target_abs_path.startswith(source_abs_path + os.sep):
+        return False, "لا يمكن نقل مجلد إلى داخل نفسه."
+    if not os.path.isdir(dest_parent_abs):
+        return False, "مجلد الوجهة غير موجود."
+
+    conn = None
+    try:
+        async with folder_lock(source_abs_path, target_abs_path):
+            if os.path.exists(target_abs_path):
+                return False, f"يوجد بالفعل عنصر باسم '{new_name}' في الوجهة."
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT is_folder FROM files WHERE file_path = %s", (source_abs_path,))
+            result = cursor.fetchone()
+            if not result:
+                return False, f"العنصر '{os.path.basename(source_abs_path)}' غير موجود في قاعدة البيانات."
+            is_folder = bool(result[0])
+
+            os.rename(source_abs_path, target_abs_path)
+            try:
+                cursor.execute("""
+                    UPDATE files SET
+                        file_path = %s || substr(file_path, %s),
+                        file_name = CASE WHEN file_path = %s THEN %s ELSE file_name END
+                    WHERE file_path = %s OR file_path LIKE %s
+                """, (target_abs_path, len(source_abs_path) + 1, source_abs_path, new_name,
+                      source_abs_path, like_prefix(source_abs_path)))
+                moved_rows = cursor.rowcount
+                if is_folder:
+                    notify_cache_invalidation(cursor, 'tree')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                os.rename(target_abs_path, source_abs_path)
+                raise
         if is_folder:
-            cursor.execute("DELETE FROM files WHERE file_path LIKE %s", (item_abs_path + '/%',))
-        conn.commit()
-        success_msg = f"تم حذف '{item_name}' بنجاح."
-        logger.info(success_msg)
-        return True, success_msg
+            invalidate_folder_tree()
+        logger.info(f"Moved {source_abs_path} -> {target_abs_path} ({moved_rows} rows)")
+        dest_display = 'الجذر' if dest_parent_abs == root_abs_path else os.path.basename(dest_parent_abs)
+        return True, f"تم نقل '{os.path.basename(source_abs_path)}' إلى '{dest_display}/{new_name}' ({moved_rows} عنصر)."
     except Exception as e:
-        logger.error(f"Error during deletion of {item_abs_path}: {e}")
-        return False, "حدث خطأ فادح أثناء عملية الحذف."
+        logger.error(f"Error during move of {source_abs_path}: {e}")
+        return False, "حدث خطأ أثناء النقل."
     finally:
         if conn:
             cursor.close()
             conn.close()
 
+async def show_move_destination_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, current_path: str):
+    root_abs_path = os.path.normpath(os.path.abspath(FILES_DIR))
+    current_abs_path = os.path.normpath(os.path.abspath(current_path))
+    source_abs_path = context.user_data.get('move_source')
+    if not source_abs_path:
+        await update.callback_query.edit_message_text("انتهت جلسة النقل. ابدأ من جديد من قائمة إدارة الملفات.")
+        return
+
+    current_rel_path = os.path.relpath(current_abs_path, root_abs_path)
+    keyboard = [[InlineKeyboardButton("✅ انقل إلى هنا", callback_data=f"move_here_{current_rel_path}")]]
+    try:
+        subfolders = get_subfolders(current_abs_path)
+    except Exception as e:
+        logger.error(f"DB error in show_move_destination_menu: {e}")
+        subfolders = []
+    for folder in subfolders:
+        if folder['path'] == source_abs_path:
+            continue
+        folder_rel_path = os.path.relpath(folder['path'], root_abs_path)
+        keyboard.append([InlineKeyboardButton(f"📂 {folder['name']}/", callback_data=f"nav_move_{folder_rel_path}")])
+    if current_abs_path != root_abs_path:
+        parent_dir_rel = os.path.relpath(os.path.dirname(current_abs_path), root_abs_path)
+        keyboard.append([InlineKeyboardButton("⬆️ عودة للمجلد الأعلى", callback_data=f"nav_move_{parent_dir_rel}")])
+    source_parent_rel = os.path.relpath(os.path.dirname(source_abs_path), root_abs_path)
+    keyboard.append([InlineKeyboardButton("❌ إلغاء النقل", callback_data=f"nav_delete_{source_parent_rel}")])
+
+    dir_name = os.path.basename(current_abs_path) if current_abs_path != root_abs_path else "الجذر"
+    message_text = f"اختر وجهة نقل `{os.path.basename(source_abs_path)}`\n\nالمسار الحالي: `{dir_name}`"
+    await update.callback_query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+async def handle_rename(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    source_abs_path = context.user_data.pop('rename_path', None)
+    context.user_data.pop('user_action', None)
+    new_name = update.message.text.strip()
+    if not source_abs_path:
+        await update.message.reply_text("انتهت جلسة إعادة التسمية. ابدأ من جديد من قائمة إدارة الملفات.")
+        return
+    if not new_name or ".." in new_name or "/" in new_name or "\\" in new_name:
+        await update.message.reply_text("الاسم الجديد يحتوي على أحرف غير مسموح بها.")
+        return
+    success, message = await move_item_logic(source_abs_path, os.path.dirname(source_abs_path), new_name)
+    await update.message.reply_text(message)
+
+@job_handler('delete')
+async def _job_delete(bot: telegram.Bot, payload: dict, report) -> str:
+    await report(f"جاري حذف '{os.path.basename(payload['path'])}'...", force=True)
+    success, message = await delete_item_logic(payload['path'])
+    if success:
+        return message
+    if message == DELETE_FAILED_MESSAGE:
+        raise RuntimeError(f"Deletion of {payload['path']} failed")
+    raise PermanentJobError(message)
+
 async def show_deletion_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, current_path: str):
     query = update.callback_query
     keyboard = []
@@ -450,8 +2262,10 @@ async def show_deletion_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         item_rel_path = os.path.relpath(item['path'], root_abs_path)
         icon = "📁" if item['is_folder'] else "📄"
         nav_button = InlineKeyboardButton(f"{icon} {item['name']}", callback_data=f"nav_delete_{item_rel_path}" if item['is_folder'] else "noop")
+        rename_button = InlineKeyboardButton("✏️", callback_data=f"start_rename_{item_rel_path}")
+        move_button = InlineKeyboardButton("📦", callback_data=f"start_move_{item_rel_path}")
         delete_button = InlineKeyboardButton("🗑️", callback_data=f"confirm_delete_{item_rel_path}")
-        keyboard.append([nav_button, delete_button])
+        keyboard.append([nav_button, rename_button, move_button, delete_button])
     
     if current_abs_path != root_abs_path:
         parent_dir_abs = os.path.dirname(current_abs_path)
@@ -461,7 +2275,7 @@ async def show_deletion_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
     keyboard.append([InlineKeyboardButton("⬅️ العودة لقائمة الإدارة", callback_data="admin_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     dir_name = os.path.basename(current_path) if current_abs_path != root_abs_path else "الجذر"
-    message_text = f"اختر عنصراً لحذفه، أو تصفح المجلدات.\n\nالمسار الحالي: `{dir_name}`"
+    message_text = f"اختر عنصراً لإعادة تسميته ✏️ أو نقله 📦 أو حذفه 🗑️، أو تصفح المجلدات.\n\nالمسار الحالي: `{dir_name}`"
     if not items_in_current_dir:
         message_text = f"المجلد *'{dir_name}'* فارغ.\n\nاضغط للعودة."
     await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -494,7 +2308,9 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         cursor = conn.cursor()
         cursor.execute("UPDATE users SET role = %s WHERE username = %s", (target_role, target_username))
         if cursor.rowcount > 0:
+            notify_cache_invalidation(cursor, 'roles')
             conn.commit()
+            invalidate_role_cache()
             await update.message.reply_text(f"تم تحديث دور @{target_username} إلى: {target_role}")
         else:
             await update.message.reply_text(f"المستخدم @{target_username} غير موجود. اطلب منه أن يرسل /start أولاً.")
@@ -525,7 +2341,9 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         cursor.execute("UPDATE users SET role = 'user' WHERE username = %s AND role != 'super_admin'", (target_username,))
         if cursor.rowcount > 0:
+            notify_cache_invalidation(cursor, 'roles')
             conn.commit()
+            invalidate_role_cache()
             await update.message.reply_text(f"تمت إزالة صلاحيات @{target_username}.")
         else:
             await update.message.reply_text(f"المستخدم @{target_username} غير موجود أو ليس لديه صلاحيات لإزالتها.")
@@ -566,31 +2384,141 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not context.args:
         await update.message.reply_text("الاستخدام: /broadcast <رسالتك>")
         return
-    message_to_send = " ".join(context.args)
+    await _broadcast(update, context, " ".join(context.args))
+
+async def broadcast_active(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/broadcast_active <أيام> <رسالة>: بث للمستخدمين النشطين خلال آخر N يوم فقط."""
+    if not is_super_admin(update.effective_user.id): return
+    if len(context.args) < 2 or not context.args[0].isdigit():
+        await update.message.reply_text("الاستخدام: /broadcast_active <عدد_الأيام> <رسالتك>")
+        return
+    await _broadcast(update, context, " ".join(context.args[1:]), active_days=int(context.args[0]))
+
+async def _broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, message_to_send: str, active_days: int = None) -> None:
+    try:
+        job_id = await submit_job('broadcast', {'message': message_to_send, 'active_days': active_days}, chat_id=update.effective_chat.id)
+    except Exception as e:
+        logger.error(f"DB error in broadcast_message: {e}")
+        await update.message.reply_text("حدث خطأ في قاعدة البيانات.")
+        return
+    await update.message.reply_text(f"تمت جدولة البث كمهمة #{job_id}، وسيصلك تقرير عند الانتهاء.")
+
+def _fetch_broadcast_recipients(active_days: int, after_user_id: int) -> list:
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if active_days is None:
+            cursor.execute("SELECT user_id FROM users WHERE user_id > %s ORDER BY user_id", (after_user_id,))
+        else:
+            cursor.execute(
+                "SELECT user_id FROM users WHERE user_id > %s AND last_seen >= NOW() - make_interval(days => %s) ORDER BY user_id",
+                (after_user_id, active_days)
+            )
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+@job_handler('broadcast')
+async def _job_broadcast(bot: telegram.Bot, payload: dict, report) -> str:
+    # الحالة تُحفظ في payload، فإعادة المحاولة تكمل من آخر مستخدم بدلاً من إعادة الإرسال للجميع
+    state = payload.get('state') or {'last_user_id': 0, 'sent': 0, 'failed': 0}
+    user_ids = await asyncio.to_thread(_fetch_broadcast_recipients, payload.get('active_days'), state['last_user_id'])
+    for i, user_id in enumerate(user_ids, 1):
+        try:
+            await bot.send_message(chat_id=user_id, text=f"رسالة من الإدارة:\n\n{payload['message']}")
+            state['sent'] += 1
+        except Exception:
+            state['failed'] += 1
+        state['last_user_id'] = user_id
+        if i % 25 == 0:
+            await report(f"تم الإرسال إلى {state['sent']} مستخدم حتى الآن...", state)
+    return f"تم بث الرسالة بنجاح إلى {state['sent']} مستخدم. فشل الإرسال إلى {state['failed']} مستخدم."
+
+async def list_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(للأدمن) تعرض آخر المهام في الطابور وحالتها."""
+    if not is_admin_or_higher(update.effective_user.id): return
     conn = None
-    all_user_ids = []
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users")
-        all_user_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT id, kind, status, attempts, progress FROM jobs ORDER BY id DESC LIMIT 10")
+        rows = cursor.fetchall()
     except Exception as e:
-        logger.error(f"DB error in broadcast_message: {e}")
+        logger.error(f"DB error in list_jobs: {e}")
         await update.message.reply_text("حدث خطأ في قاعدة البيانات.")
         return
     finally:
         if conn:
             cursor.close()
             conn.close()
+    if not rows:
+        await update.message.reply_text("لا توجد مهام مسجلة.")
+        return
+    lines = ["🗂️ آخر المهام:"]
+    for job_id, kind, status, attempts, progress in rows:
+        lines.append(f"#{job_id} {kind} — {status} (محاولات: {attempts})" + (f"\n   {progress}" if progress else ""))
+    await update.message.reply_text("\n".join(lines))
 
-    success_count, fail_count = 0, 0
-    for user_id in all_user_ids:
+async def change_log_level(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/loglevel [LEVEL]: تعرض مستوى السجلات الحالي أو تغيّره دون إعادة تشغيل (ولكل النسخ في وضع webhook)."""
+    if not is_super_admin(update.effective_user.id): return
+    if not context.args:
+        current_level = logging.getLevelName(logging.getLogger().level)
+        await update.message.reply_text(f"مستوى السجلات الحالي: {current_level}\nالاستخدام: /loglevel <{'|'.join(LOG_LEVELS)}>")
+        return
+    level = context.args[0].upper()
+    if level not in LOG_LEVELS:
+        await update.message.reply_text(f"مستوى غير صالح. المستويات المتاحة: {', '.join(LOG_LEVELS)}")
+        return
+    set_log_level(level)
+    if MULTI_REPLICA:
+        conn = None
         try:
-            await context.bot.send_message(chat_id=user_id, text=f"رسالة من الإدارة:\n\n{message_to_send}")
-            success_count += 1
-        except Exception:
-            fail_count += 1
-    await update.message.reply_text(f"تم بث الرسالة بنجاح إلى {success_count} مستخدم. فشل الإرسال إلى {fail_count} مستخدم.")
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            notify_cache_invalidation(cursor, 'loglevel', level)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Could not propagate log level to other replicas: {e}")
+        finally:
+            if conn:
+                cursor.close()
+                conn.close()
+    logger.warning(f"Log level changed to {level} by {update.effective_user.id}")
+    await update.message.reply_text(f"تم تغيير مستوى السجلات إلى: {level}")
+
+async def show_usage_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/activity [أيام] [csv]: رسم نصي مختصر للنشاط اليومي، أو ملف CSV بنفس البيانات."""
+    if not is_admin_or_higher(update.effective_user.id): return
+    args = context.args or []
+    as_csv = 'csv' in args
+    day_args = [arg for arg in args if arg != 'csv']
+    if len(day_args) > 1 or (day_args and not day_args[0].isdigit()):
+        await update.message.reply_text("الاستخدام: /activity [عدد_الأيام] [csv]")
+        return
+    days = min(max(int(day_args[0]) if day_args else USAGE_REPORT_DAYS, 1), USAGE_MAX_DAYS)
+    await flush_usage_rollups()
+    try:
+        rows = await asyncio.to_thread(_fetch_daily_usage, days)
+    except Exception as e:
+        logger.error(f"DB error in show_usage_history: {e}")
+        response = "حدث خطأ في قاعدة البيانات."
+        if update.callback_query:
+            await update.callback_query.edit_message_text(response)
+        else:
+            await update.message.reply_text(response)
+        return
+
+    if update.callback_query:
+        keyboard = [[InlineKeyboardButton("⬅️ العودة لأوامر الإدارة", callback_data="admin_menu")]]
+        await update.callback_query.edit_message_text(render_usage_chart(rows), reply_markup=InlineKeyboardMarkup(keyboard))
+    elif as_csv:
+        await update.message.reply_document(document=render_usage_csv(rows), filename=f"usage_{rows[0][0]}_{rows[-1][0]}.csv")
+    else:
+        await update.message.reply_text(render_usage_chart(rows))
 
 async def show_stats_from_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin_or_higher(update.effective_user.id): return
@@ -600,6 +2528,8 @@ async def show_stats_from_button(update: Update, context: ContextTypes.DEFAULT_T
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM users")
         total_users = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM users WHERE last_seen >= NOW() - INTERVAL '7 days'")
+        active_users = cursor.fetchone()[0]
         cursor.execute("SELECT COUNT(*) FROM files WHERE is_folder = FALSE")
         total_files = cursor.fetchone()[0]
         cursor.execute("SELECT COUNT(*) FROM files WHERE is_folder = TRUE")
@@ -610,11 +2540,15 @@ async def show_stats_from_button(update: Update, context: ContextTypes.DEFAULT_T
         stats_message = (
             f"📊 *إحصائيات البوت:*\n\n"
             f"👤 *إجمالي المستخدمين*: {total_users}\n"
+            f"🟢 *النشطون (آخر 7 أيام)*: {active_users}\n"
             f"📄 *إجمالي الملفات*: {total_files}\n"
             f"📁 *إجمالي المجلدات*: {total_folders}\n"
             f"📦 *إجمالي حجم الملفات*: {total_size_mb:.2f} MB"
         )
-        keyboard = [[InlineKeyboardButton("⬅️ العودة لأوامر الإدارة", callback_data="admin_menu")]]
+        keyboard = [
+            [InlineKeyboardButton(f"📈 النشاط (آخر {USAGE_REPORT_DAYS} يوم)", callback_data="admin_activity_button")],
+            [InlineKeyboardButton("⬅️ العودة لأوامر الإدارة", callback_data="admin_menu")],
+        ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.callback_query.edit_message_text(stats_message, reply_markup=reply_markup, parse_mode='Markdown')
     except Exception as e:
@@ -635,12 +2569,13 @@ async def list_files_with_buttons(message: telegram.Message, context: ContextTyp
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT file_name, file_path, is_folder FROM files ORDER BY is_folder DESC, file_name ASC")
+        cursor.execute("SELECT id, file_name, file_path, is_folder, page_count, thumbnail_path FROM files ORDER BY is_folder DESC, file_name ASC")
         all_items_db = cursor.fetchall()
         current_abs_path = os.path.abspath(current_dir)
-        for name, path, is_folder in all_items_db:
+        for file_id, name, path, is_folder, page_count, thumbnail_path in all_items_db:
             if os.path.dirname(os.path.abspath(path)) == current_abs_path:
-                items_in_current_dir.append({"name": name, "is_folder": is_folder, "path": path})
+                items_in_current_dir.append({"id": file_id, "name": name, "is_folder": is_folder, "path": path,
+                                             "page_count": page_count, "thumbnail_path": thumbnail_path})
     except Exception as e:
         logger.error(f"Error listing files from DB: {e}")
     finally:
@@ -653,7 +2588,19 @@ async def list_files_with_buttons(message: telegram.Message, context: ContextTyp
             keyboard.append([InlineKeyboardButton(f"📁 {item['name']}/", callback_data=f"ls_{item['name']}")])
         else:
             item_rel_path = os.path.relpath(item['path'], root_abs_path)
-            keyboard.append([InlineKeyboardButton(f"📄 {item['name']}", callback_data=f"download_{item_rel_path}")])
+            label = f"📄 {item['name']}" + (f" ({item['page_count']} ص)" if item['page_count'] else "")
+            row = [InlineKeyboardButton(label, callback_data=f"download_{item['id']}")]
+            if item['thumbnail_path']:
+                row.append(InlineKeyboardButton("🖼️", callback_data=f"preview_{item_rel_path}"))
+            keyboard.append(row)
+
+    file_ids = [item['id'] for item in items_in_current_dir if not item['is_folder']]
+    if file_ids:
+        record_views(file_ids)
+        keyboard.append([
+            InlineKeyboardButton("🔥 الأكثر تنزيلاً", callback_data="popular_here"),
+            InlineKeyboardButton("🆕 أحدث الملفات", callback_data="recent_here"),
+        ])
     
     if os.path.abspath(current_dir) != root_abs_path:
         parent_dir = os.path.dirname(current_dir)
@@ -667,63 +2614,49 @@ async def list_files_with_buttons(message: telegram.Message, context: ContextTyp
     await message.edit_text(response_text, reply_markup=reply_markup, parse_mode='Markdown')
 
 
-async def download_file_from_button(query: telegram.CallbackQuery, context: ContextTypes.DEFAULT_TYPE, relative_path: str) -> None:
-    user_username = query.from_user.username
-    root_abs_path = os.path.abspath(FILES_DIR)
-    file_abs_path = os.path.abspath(os.path.join(root_abs_path, relative_path))
-
-    if not file_abs_path.startswith(root_abs_path):
-        await query.answer("خطأ أمني: مسار غير صالح.", show_alert=True)
-        return
+async def save_telegram_file(bot_file: telegram.File, final_path: str) -> None:
+    """
+    تحفظ ملفاً مستلماً في FILES_DIR.
+    مع خادم Bot API محلي يكون file_path مساراً على نفس القرص، فيُنقل الملف بدلاً من تنزيله عبر HTTP.
+    """
+    if LOCAL_BOT_API and bot_file.file_path and os.path.isabs(bot_file.file_path):
+        try:
+            # rename على نفس نظام الملفات، ونسخ ثم حذف إذا كان الخادم على قرص آخر
+            await asyncio.to_thread(shutil.move, bot_file.file_path, final_path)
+            return
+        except OSError as e:
+            logger.warning(f"Could not move {bot_file.file_path} from the local Bot API server, downloading instead: {e}")
+    await bot_file.download_to_drive(final_path)
 
+def _insert_file_row(file_name: str, file_path: str, size_bytes: int, user_id: int) -> int:
+    conn = None
     try:
-        if os.path.isfile(file_abs_path):
-            await context.bot.send_document(chat_id=query.from_user.id, document=open(file_abs_path, 'rb'))
-            await query.answer(f"جاري إرسال: {os.path.basename(file_abs_path)}")
-            logger.info(f"User {user_username} downloaded {file_abs_path}")
-        else:
-            await query.answer("خطأ: الملف لم يعد موجوداً.", show_alert=True)
-    except Exception as e:
-        logger.error(f"Error sending file from button: {e}")
-        await query.answer("حدث خطأ أثناء إرسال الملف.", show_alert=True)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO files (file_name, file_path, size_bytes, uploaded_by, is_folder) VALUES (%s, %s, %s, %s, FALSE) RETURNING id",
+            (file_name, file_path, size_bytes, user_id)
+        )
+        file_id = cursor.fetchone()[0]
+        conn.commit()
+        return file_id
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
 
-async def handle_button_press(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def store_uploaded_file(bot: telegram.Bot, pending_file: dict, destination_path: str, user_id: int) -> str:
     """
-    (النسخة الكاملة والمحدثة)
-    تتعامل مع جميع ضغطات الأزرار بشكل صحيح.
+    تحفظ ملفاً مرفوعاً في المجلد المختار وتسجله في قاعدة البيانات؛ تُرجع المسار النهائي.
+    تحجز حجم الملف من حصة المستخدم قبل التنزيل (StorageQuotaError عند التجاوز) وتعيده إذا فشل الحفظ.
     """
-    query = update.callback_query
-    await query.answer()
-
-    data = query.data
-    user_id = query.from_user.id
-    user_username = query.from_user.username
-
-    logger.info(f"User {user_username} (ID: {user_id}) pressed button with data: '{data}'")
-    
-    root_abs_path = os.path.abspath(FILES_DIR)
-
-    # --- 1. منطق الرفع الذكي ---
-    if data.startswith("nav_upload_"):
-        relative_path = data.split('_', 2)[-1]
-        path_to_navigate = os.path.abspath(os.path.join(root_abs_path, relative_path))
-        await show_upload_destination_menu(update, context, path_to_navigate)
-        return
-        
-    elif data.startswith("upload_to_"):
-        relative_path = data.split('_', 2)[-1]
-        destination_path = os.path.abspath(os.path.join(root_abs_path, relative_path))
-        
-        pending_file = context.user_data.pop('pending_upload', None)
-        if not pending_file:
-            await query.edit_message_text("عذرًا، يبدو أن جلسة الرفع قد انتهت. الرجاء إرسال الملف مرة أخرى.")
-            return
-
-        await query.edit_message_text(f"جاري حفظ الملف `{pending_file['file_name']}`...")
+    size_bytes = pending_file['file_size'] or 0
+    await asyncio.to_thread(reserve_storage, user_id, size_bytes)
+    try:
+        bot_file = await bot.get_file(pending_file['file_id'])
 
-        try:
-            bot_file = await context.bot.get_file(pending_file['file_id'])
-            
+        # القفل على اسم الملف المطلوب يمنع رفعين متزامنين بنفس الاسم من اختيار نفس المسار
+        async with folder_lock(os.path.join(destination_path, pending_file['file_name'])):
             # منع الكتابة فوق الملفات الموجودة
             base_name, ext = os.path.splitext(pending_file['file_name'])
             counter = 1
@@ -733,162 +2666,477 @@ async def handle_button_press(update: Update, context: ContextTypes.DEFAULT_TYPE
                 final_path = os.path.join(destination_path, new_file_name)
                 counter += 1
 
-            await bot_file.download_to_drive(final_path)
-            
+            await save_telegram_file(bot_file, final_path)
+
             # حفظ معلومات الملف في قاعدة بيانات PostgreSQL
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO files (file_name, file_path, size_bytes, uploaded_by, is_folder) VALUES (%s, %s, %s, %s, FALSE)",
-                (os.path.basename(final_path), final_path, pending_file['file_size'], user_id)
-            )
-            conn.commit()
+            file_id = await asyncio.to_thread(_insert_file_row, os.path.basename(final_path), final_path, pending_file['file_size'], user_id)
+    except BaseException:
+        await asyncio.to_thread(release_storage, user_id, size_bytes)
+        raise
+    record_usage('uploads')
+    record_usage('bytes_added', size_bytes)
+    schedule_metadata_extraction(file_id, final_path)
+    return final_path
+
+@job_handler('upload')
+async def _job_upload(bot: telegram.Bot, payload: dict, report) -> str:
+    pending_file = payload['file']
+    await report(f"جاري حفظ الملف {pending_file['file_name']}...", force=True)
+    final_path = await store_uploaded_file(bot, pending_file, payload['destination'], payload['user_id'])
+    return f"تم حفظ الملف '{os.path.basename(final_path)}' بنجاح."
+
+async def download_file_from_button(query: telegram.CallbackQuery, context: ContextTypes.DEFAULT_TYPE, file_id: int, file_abs_path: str) -> None:
+    """file_abs_path مسار الصف file_id كما في قاعدة البيانات، وقد تحقق المستدعي من وقوعه داخل FILES_DIR."""
+    user_username = query.from_user.username
+
+    if not os.path.isfile(file_abs_path):
+        await query.answer("خطأ: الملف لم يعد موجوداً.", show_alert=True)
+        return
+
+    # نجيب على الزر قبل الإرسال حتى لا يبقى مؤشر التحميل معلقاً أثناء رفع الملف
+    await query.answer(f"جاري إرسال: {os.path.basename(file_abs_path)}")
+    try:
+        # مع خادم Bot API محلي يُرسل المسار فقط (file://) ويقرأ الخادم الملف من القرص مباشرة
+        await context.bot.send_document(chat_id=query.from_user.id, document=Path(file_abs_path))
+        record_download(file_id)
+        logger.info(f"User {user_username} downloaded {file_abs_path}")
+    except Exception as e:
+        logger.error(f"Error sending file from button: {e}")
+        await context.bot.send_message(chat_id=query.from_user.id, text="حدث خطأ أثناء إرسال الملف.")
+
+async def show_ranked_files(query: telegram.CallbackQuery, context: ContextTypes.DEFAULT_TYPE, ranking: str) -> None:
+    """تعرض الملفات الأكثر تنزيلاً أو الأحدث داخل المجلد الحالي (وما تحته) من جداول الإحصائيات."""
+    root_abs_path = os.path.abspath(FILES_DIR)
+    current_abs_path = os.path.abspath(context.user_data.get(f"{query.from_user.id}_current_path", root_abs_path))
+    if ranking == 'popular':
+        sql = """
+            SELECT f.id, f.file_name, s.downloads FROM files f
+            JOIN file_stats s ON s.file_id = f.id
+            WHERE f.is_folder = FALSE AND f.file_path LIKE %s AND s.downloads > 0
+            ORDER BY s.downloads DESC, f.file_name LIMIT %s
+        """
+    else:
+        sql = """
+            SELECT id, file_name, upload_date FROM files
+            WHERE is_folder = FALSE AND file_path LIKE %s
+            ORDER BY upload_date DESC LIMIT %s
+        """
+    rows = []
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(sql, (like_prefix(current_abs_path), RANKING_LIMIT))
+        rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"DB error in show_ranked_files: {e}")
+    finally:
+        if conn:
             cursor.close()
             conn.close()
 
-            await query.answer(f"✅ تم حفظ الملف بنجاح!", show_alert=False)
-            logger.info(f"User {user_username} completed upload of '{os.path.basename(final_path)}' to '{destination_path}'.")
-            await list_files_with_buttons(query.message, context, destination_path)
+    keyboard = []
+    for file_id, name, value in rows:
+        label = f"{value}⬇️" if ranking == 'popular' else value.strftime('%Y-%m-%d')
+        keyboard.append([InlineKeyboardButton(f"📄 {name} ({label})", callback_data=f"download_{file_id}")])
+    keyboard.append([InlineKeyboardButton("⬅️ العودة للمجلد", callback_data="ls_.")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    current_display_name = 'الجذر' if current_abs_path == root_abs_path else os.path.basename(current_abs_path)
+    title = "🔥 الأكثر تنزيلاً" if ranking == 'popular' else "🆕 أحدث الملفات"
+    response_text = f"{title} في *{current_display_name}*" if rows else f"لا توجد بيانات بعد لـ *{current_display_name}*."
+    await query.edit_message_text(response_text, reply_markup=reply_markup, parse_mode='Markdown')
 
-        except Exception as e:
-            logger.error(f"Error during final file save operation: {e}")
-            await query.edit_message_text("حدث خطأ فادح أثناء حفظ الملف.")
+# --- موجّه أزرار الاستدعاء (Callback Router) ---
+# كل زر يُسجَّل مرة واحدة مع الصلاحية المطلوبة وطريقة فك وسيطه، بدلاً من سلسلة طويلة من الشروط.
+# المسارات الثابتة تُبحث في قاموس مباشرة، والمسارات ذات البادئة تُفهرس حسب المقطع الأول قبل '_'.
+
+_exact_routes = {}
+_prefix_routes = {}  # المقطع الأول -> قائمة (البادئة، المسار) مرتبة من الأطول للأقصر
+route_stats = {}  # اسم المسار -> {'count', 'errors', 'total_ms', 'max_ms'}
+
+def resolve_relative_path(relative_path: str) -> str:
+    """تحوّل مساراً نسبياً قادماً من زر إلى مسار مطلق، وترفض أي مسار يخرج عن FILES_DIR."""
+    root_abs_path = os.path.abspath(FILES_DIR)
+    abs_path = os.path.abspath(os.path.join(root_abs_path, relative_path))
+    if abs_path != root_abs_path and not abs_path.startswith(root_abs_path + os.sep):
+        raise ValueError(f"Path escapes FILES_DIR: {relative_path}")
+    return abs_path
+
+def callback_route(pattern: str, prefix: bool = False, permission: str = None, decode=None, answer: bool = True):
+    """
+    تسجّل دالة كمعالج لزر.
+    - prefix: يطابق أي بيانات تبدأ بـ pattern ويمرر الباقي كوسيط.
+    - permission: أدنى دور مطلوب (من ROLE_LEVELS).
+    - decode: دالة تحوّل الوسيط النصي قبل تمريره (ترفع ValueError عند الرفض).
+    - answer: إذا كانت False فالمعالج يجيب على الزر بنفسه.
+    """
+    def register(func):
+        route = {'name': pattern, 'func': func, 'permission': permission, 'decode': decode, 'answer': answer}
+        route_stats[pattern] = {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        if prefix:
+            bucket = _prefix_routes.setdefault(pattern.split('_', 1)[0], [])
+            bucket.append((pattern, route))
+            bucket.sort(key=lambda item: len(item[0]), reverse=True)
+        else:
+            _exact_routes[pattern] = route
+        return func
+    return register
+
+def match_callback_route(data: str):
+    """تُرجع (المسار، الوسيط النصي) أو (None، None) إذا لم يُسجل معالج لهذه البيانات."""
+    route = _exact_routes.get(data)
+    if route:
+        return route, None
+    for pattern, route in _prefix_routes.get(data.split('_', 1)[0], ()):
+        if data.startswith(pattern):
+            return route, data[len(pattern):]
+    return None, None
+
+def _record_route_timing(name: str, elapsed_ms: float, failed: bool) -> None:
+    stats = route_stats[name]
+    stats['count'] += 1
+    stats['total_ms'] += elapsed_ms
+    if elapsed_ms > stats['max_ms']:
+        stats['max_ms'] = elapsed_ms
+    if failed:
+        stats['errors'] += 1
+
+async def handle_button_press(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """تستقبل جميع ضغطات الأزرار وتوجهها إلى المعالج المسجل لها."""
+    query = update.callback_query
+    data = query.data or ""
+    user_id = query.from_user.id
+    if sampled_debug():
+        logger.debug("User %s pressed button with data: %r", user_id, data)
+
+    route, raw_arg = match_callback_route(data)
+    if route is None:
+        logger.warning(f"Unhandled button callback data: {data}")
+        await query.answer("هذا الزر ليس له وظيفة محددة بعد.")
         return
 
-    elif data == "cancel_upload":
-        context.user_data.pop('pending_upload', None)
-        await query.edit_message_text("تم إلغاء عملية الرفع.")
-        await send_main_keyboard(update, context)
+    bind_log_handler(route['name'])
+
+    if route['permission'] and not has_role_at_least(user_id, route['permission']):
+        await query.answer("عذرًا، أنت لا تملك الصلاحية.", show_alert=True)
         return
 
-    # --- 2. منطق الحذف التفاعلي ---
-    elif data == "admin_delete_start":
-        await show_deletion_menu(update, context, root_abs_path)
+    arg = raw_arg
+    if route['decode'] and raw_arg is not None:
+        try:
+            arg = route['decode'](raw_arg)
+        except ValueError:
+            logger.warning(f"Rejected callback argument from {user_id}: {data}")
+            await query.answer("خطأ أمني: مسار غير صالح.", show_alert=True)
+            return
+
+    if route['answer']:
+        await query.answer()
+
+    started = time.perf_counter()
+    failed = True
+    try:
+        await route['func'](update, context, arg)
+        failed = False
+    finally:
+        _record_route_timing(route['name'], (time.perf_counter() - started) * 1000, failed)
+
+async def show_route_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """(للأدمن) تعرض عدد الضغطات وزمن الاستجابة لكل زر، مرتبة من الأكثر استخداماً."""
+    if not is_admin_or_higher(update.effective_user.id): return
+    used = sorted(((name, s) for name, s in route_stats.items() if s['count']), key=lambda item: item[1]['count'], reverse=True)
+    if not used:
+        await update.message.reply_text("لم يتم تسجيل أي ضغطات أزرار منذ آخر تشغيل.")
         return
-        
-    elif data.startswith("nav_delete_"):
-        relative_path = data.split('_', 2)[-1]
-        path_to_navigate = os.path.abspath(os.path.join(root_abs_path, relative_path))
-        await show_deletion_menu(update, context, path_to_navigate)
+    lines = ["📈 إحصائيات الأزرار (العدد | المتوسط | الأقصى | الأخطاء):"]
+    for name, s in used:
+        lines.append(f"{name}: {s['count']} | {s['total_ms'] / s['count']:.1f}ms | {s['max_ms']:.1f}ms | {s['errors']}")
+    await update.message.reply_text("\n".join(lines))
+
+# --- 1. منطق الرفع الذكي ---
+
+@callback_route("nav_upload_", prefix=True, permission='uploader', decode=resolve_relative_path)
+async def _cb_nav_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, path_to_navigate: str) -> None:
+    await show_upload_destination_menu(update, context, path_to_navigate)
+
+@callback_route("upload_to_", prefix=True, permission='uploader', decode=resolve_relative_path)
+async def _cb_upload_to(update: Update, context: ContextTypes.DEFAULT_TYPE, destination_path: str) -> None:
+    query = update.callback_query
+    user_id = query.from_user.id
+    user_username = query.from_user.username
+
+    pending_file = context.user_data.pop('pending_upload', None)
+    if not pending_file:
+        await query.edit_message_text("عذرًا، يبدو أن جلسة الرفع قد انتهت. الرجاء إرسال الملف مرة أخرى.")
         return
 
-    elif data.startswith("confirm_delete_"):
-        relative_path = data.split('_', 2)[-1]
-        item_name = os.path.basename(relative_path)
-        parent_rel_path = os.path.dirname(relative_path) if os.path.dirname(relative_path) else '.'
-        
-        keyboard = [[
-            InlineKeyboardButton("✅ نعم، احذف الآن", callback_data=f"execute_delete_{relative_path}"),
-            InlineKeyboardButton("❌ لا، إلغاء", callback_data=f"nav_delete_{parent_rel_path}")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"⚠️ هل أنت متأكد من حذف '{item_name}'؟\n\n**لا يمكن التراجع عن هذا الإجراء!**", reply_markup=reply_markup, parse_mode='Markdown')
+    try:
+        await asyncio.to_thread(check_storage_quota, user_id, pending_file['file_size'] or 0)
+    except StorageQuotaError as e:
+        await query.edit_message_text(str(e))
         return
 
-    elif data.startswith("execute_delete_"):
-        relative_path = data.split('_', 2)[-1]
-        item_abs_path = os.path.abspath(os.path.join(root_abs_path, relative_path))
-        
+    if (pending_file['file_size'] or 0) >= JOB_UPLOAD_THRESHOLD:
+        # الملفات الكبيرة تُحفظ عبر طابور المهام حتى لا تضيع عند إعادة التشغيل
+        job_id = await submit_job('upload', {'file': pending_file, 'destination': destination_path, 'user_id': user_id},
+                                  chat_id=user_id, priority=20)
+        await query.edit_message_text(f"تمت جدولة حفظ الملف `{pending_file['file_name']}` كمهمة #{job_id}، وسيصلك إشعار عند الانتهاء.")
+        return
+
+    await query.edit_message_text(f"جاري حفظ الملف `{pending_file['file_name']}`...")
+
+    try:
+        final_path = await store_uploaded_file(context.bot, pending_file, destination_path, user_id)
+        logger.info(f"User {user_username} completed upload of '{os.path.basename(final_path)}' to '{destination_path}'.")
+        await list_files_with_buttons(query.message, context, destination_path)
+
+    except StorageQuotaError as e:
+        await query.edit_message_text(str(e))
+    except Exception as e:
+        logger.error(f"Error during final file save operation: {e}")
+        await query.edit_message_text("حدث خطأ فادح أثناء حفظ الملف.")
+
+@callback_route("cancel_upload")
+async def _cb_cancel_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    context.user_data.pop('pending_upload', None)
+    await update.callback_query.edit_message_text("تم إلغاء عملية الرفع.")
+    await send_main_keyboard(update, context)
+
+# --- 2. منطق الحذف التفاعلي ---
+
+@callback_route("admin_delete_start", permission='admin')
+async def _cb_admin_delete_start(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_deletion_menu(update, context, os.path.abspath(FILES_DIR))
+
+@callback_route("nav_delete_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_nav_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, path_to_navigate: str) -> None:
+    await show_deletion_menu(update, context, path_to_navigate)
+
+@callback_route("confirm_delete_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, item_abs_path: str) -> None:
+    relative_path = os.path.relpath(item_abs_path, os.path.abspath(FILES_DIR))
+    item_name = os.path.basename(relative_path)
+    parent_rel_path = os.path.dirname(relative_path) if os.path.dirname(relative_path) else '.'
+
+    keyboard = [[
+        InlineKeyboardButton("✅ نعم، احذف الآن", callback_data=f"execute_delete_{relative_path}"),
+        InlineKeyboardButton("❌ لا، إلغاء", callback_data=f"nav_delete_{parent_rel_path}")
+    ]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.callback_query.edit_message_text(f"⚠️ هل أنت متأكد من حذف '{item_name}'؟\n\n**لا يمكن التراجع عن هذا الإجراء!**", reply_markup=reply_markup, parse_mode='Markdown')
+
+@callback_route("execute_delete_", prefix=True, permission='admin', decode=resolve_relative_path, answer=False)
+async def _cb_execute_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, item_abs_path: str) -> None:
+    query = update.callback_query
+    if os.path.isdir(item_abs_path):
+        # حذف المجلدات قد يطول، فيُنفذ عبر طابور المهام ويصل التقرير كرسالة
+        job_id = await submit_job('delete', {'path': item_abs_path}, chat_id=query.from_user.id, priority=10)
+        await query.answer(f"تمت جدولة حذف '{os.path.basename(item_abs_path)}' كمهمة #{job_id}.", show_alert=True)
+    else:
         success, message = await delete_item_logic(item_abs_path)
         await query.answer(message, show_alert=True)
-        
-        parent_abs_path = os.path.dirname(item_abs_path)
-        await show_deletion_menu(update, context, parent_abs_path)
-        return
-        
-    elif data == "noop": # زر لا يفعل شيئاً (يستخدم بجانب أزرار الحذف للملفات)
+    await show_deletion_menu(update, context, os.path.dirname(item_abs_path))
+
+@callback_route("start_rename_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_start_rename(update: Update, context: ContextTypes.DEFAULT_TYPE, item_abs_path: str) -> None:
+    context.user_data['user_action'] = 'awaiting_rename'
+    context.user_data['rename_path'] = item_abs_path
+    await update.callback_query.edit_message_text(f"أرسل الاسم الجديد لـ `{os.path.basename(item_abs_path)}` كرسالة نصية.", parse_mode='Markdown')
+
+@callback_route("start_move_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_start_move(update: Update, context: ContextTypes.DEFAULT_TYPE, item_abs_path: str) -> None:
+    context.user_data['move_source'] = item_abs_path
+    await show_move_destination_menu(update, context, os.path.abspath(FILES_DIR))
+
+@callback_route("nav_move_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_nav_move(update: Update, context: ContextTypes.DEFAULT_TYPE, path_to_navigate: str) -> None:
+    await show_move_destination_menu(update, context, path_to_navigate)
+
+@callback_route("move_here_", prefix=True, permission='admin', decode=resolve_relative_path, answer=False)
+async def _cb_move_here(update: Update, context: ContextTypes.DEFAULT_TYPE, dest_parent_abs: str) -> None:
+    source_abs_path = context.user_data.pop('move_source', None)
+    if not source_abs_path:
+        await update.callback_query.answer("انتهت جلسة النقل.", show_alert=True)
         return
+    success, message = await move_item_logic(source_abs_path, dest_parent_abs)
+    await update.callback_query.answer(message, show_alert=True)
+    await show_deletion_menu(update, context, dest_parent_abs if success else os.path.dirname(source_abs_path))
 
-    # --- 3. منطق إنشاء المجلدات التفاعلي ---
-    elif data.startswith("nav_create_"):
-        relative_path = data.split('_', 2)[-1]
-        path_to_navigate = os.path.abspath(os.path.join(root_abs_path, relative_path))
-        await show_folder_creation_menu(update, context, path_to_navigate)
-        return
+@callback_route("noop")
+async def _cb_noop(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    # زر لا يفعل شيئاً (يستخدم بجانب أزرار الحذف للملفات)
+    return
 
-    elif data.startswith("create_here_"):
-        relative_path = data.split('_', 2)[-1]
-        creation_path = os.path.abspath(os.path.join(root_abs_path, relative_path))
-        context.user_data['user_action'] = 'awaiting_new_folder_name'
-        context.user_data['creation_path'] = creation_path
-        
-        dir_name = os.path.basename(creation_path) if creation_path != root_abs_path else "الجذر"
-        await query.edit_message_text(f"تم اختيار الإنشاء في: `{dir_name}`\n\nالآن، أرسل اسم المجلد الجديد كرسالة نصية.", parse_mode='Markdown')
-        return
+# --- 3. منطق إنشاء المجلدات التفاعلي ---
 
-    # --- 4. منطق تصفح الملفات وتنزيلها ---
-    elif data.startswith("ls_"):
-        target_path_segment = data[len("ls_"):]
-        current_path_key = f"{user_id}_current_path"
-        current_path = context.user_data.get(current_path_key, root_abs_path)
+@callback_route("nav_create_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_nav_create(update: Update, context: ContextTypes.DEFAULT_TYPE, path_to_navigate: str) -> None:
+    await show_folder_creation_menu(update, context, path_to_navigate)
 
-        if target_path_segment == "root": new_path = root_abs_path
-        elif target_path_segment == "..": new_path = os.path.dirname(current_path)
-        else: new_path = os.path.join(current_path, target_path_segment)
-        
-        abs_new_path = os.path.abspath(new_path)
-        if not abs_new_path.startswith(root_abs_path):
-            await query.edit_message_text("عذرًا، لا يمكنك الوصول إلى هذا المسار.")
-            return
+@callback_route("create_here_", prefix=True, permission='admin', decode=resolve_relative_path)
+async def _cb_create_here(update: Update, context: ContextTypes.DEFAULT_TYPE, creation_path: str) -> None:
+    context.user_data['user_action'] = 'awaiting_new_folder_name'
+    context.user_data['creation_path'] = creation_path
+
+    dir_name = os.path.basename(creation_path) if creation_path != os.path.abspath(FILES_DIR) else "الجذر"
+    await update.callback_query.edit_message_text(f"تم اختيار الإنشاء في: `{dir_name}`\n\nالآن، أرسل اسم المجلد الجديد كرسالة نصية.", parse_mode='Markdown')
+
+# --- 4. منطق تصفح الملفات وتنزيلها ---
 
-        context.user_data[current_path_key] = abs_new_path
-        await list_files_with_buttons(query.message, context, abs_new_path)
+@callback_route("ls_", prefix=True)
+async def _cb_ls(update: Update, context: ContextTypes.DEFAULT_TYPE, target_path_segment: str) -> None:
+    query = update.callback_query
+    root_abs_path = os.path.abspath(FILES_DIR)
+    current_path_key = f"{query.from_user.id}_current_path"
+    current_path = context.user_data.get(current_path_key, root_abs_path)
+
+    if target_path_segment == "root": new_path = root_abs_path
+    elif target_path_segment == "..": new_path = os.path.dirname(current_path)
+    else: new_path = os.path.join(current_path, target_path_segment)
+
+    abs_new_path = os.path.abspath(new_path)
+    if abs_new_path != root_abs_path and not abs_new_path.startswith(root_abs_path + os.sep):
+        await query.edit_message_text("عذرًا، لا يمكنك الوصول إلى هذا المسار.")
         return
 
-    elif data.startswith("download_"):
-        relative_path_to_download = data.split('_', 1)[-1]
-        await download_file_from_button(query, context, relative_path_to_download)
+    context.user_data[current_path_key] = abs_new_path
+    await list_files_with_buttons(query.message, context, abs_new_path)
+
+def _fetch_file_path(file_id: int):
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT file_path FROM files WHERE id = %s AND is_folder = FALSE", (file_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+
+@callback_route("download_", prefix=True, decode=int, answer=False)
+async def _cb_download(update: Update, context: ContextTypes.DEFAULT_TYPE, file_id: int) -> None:
+    """الزر يحمل معرّف الصف، فيبقى صالحاً بعد نقل الملف أو إعادة تسميته."""
+    query = update.callback_query
+    try:
+        file_abs_path = await asyncio.to_thread(_fetch_file_path, file_id)
+    except Exception as e:
+        logger.error(f"DB error resolving file {file_id} for download: {e}")
+        await query.answer("حدث خطأ في قاعدة البيانات.", show_alert=True)
+        return
+    root_abs_path = os.path.abspath(FILES_DIR)
+    if not file_abs_path or not os.path.abspath(file_abs_path).startswith(root_abs_path + os.sep):
+        await query.answer("خطأ: الملف لم يعد موجوداً.", show_alert=True)
         return
+    await download_file_from_button(query, context, file_id, file_abs_path)
 
-    # --- 5. أزرار القوائم العامة والإدارية ---
-    elif data == "main_menu":
-        await send_main_keyboard(update, context)
-    elif data == "admin_menu":
-        await send_admin_menu(update, context)
-    elif data == "admin_roles_menu":
-        await send_admin_roles_menu(update, context)
-    elif data == "my_role":
-        await my_role(update, context)
-    elif data == "contact_admin_btn":
-        await query.edit_message_text(
-            "للتواصل مع الإدارة، استخدم الأمر: `/contact_admin <رسالتك>`",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]])
-        )
-    elif data == "admin_newfolder": # <-- هذا هو الشرط الذي كان مفقودًا
-        if is_admin_or_higher(user_id):
-            await show_folder_creation_menu(update, context, root_abs_path)
-        else:
-            await query.answer("عذرًا، أنت لا تملك الصلاحية.", show_alert=True)
+@callback_route("preview_", prefix=True, decode=resolve_relative_path)
+async def _cb_preview(update: Update, context: ContextTypes.DEFAULT_TYPE, file_abs_path: str) -> None:
+    """ترسل الصورة المصغرة المخزنة بدلاً من الملف الكامل."""
+    thumbnail_path = None
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT thumbnail_path FROM files WHERE file_path = %s", (file_abs_path,))
+        result = cursor.fetchone()
+        thumbnail_path = result[0] if result else None
+    except Exception as e:
+        logger.error(f"DB error in preview: {e}")
+    finally:
+        if conn:
+            cursor.close()
+            conn.close()
+    if not thumbnail_path or not os.path.isfile(thumbnail_path):
+        await context.bot.send_message(chat_id=update.callback_query.from_user.id, text="لا توجد معاينة متاحة لهذا الملف.")
         return
-    elif data == "admin_stats_button":
-        await show_stats_from_button(update, context)
-    elif data == "admin_list_admins_button":
-        await list_admins_from_button(update, context)
-        
-    # --- 6. الأزرار التي تعرض مساعدة نصية للأوامر ---
-    elif data == "admin_upload_info":
-        await query.edit_message_text(
-            "لرفع ملف، قم بإرساله مباشرة إلى البوت في أي وقت وسيتم توجيهك.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_menu")]])
-        )
-    elif data == "admin_set_role":
-        await query.edit_message_text(
-            "لتعيين دور: `/addadmin @username <role>`",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_roles_menu")]])
-        )
-    elif data == "admin_remove_role":
-        await query.edit_message_text(
-            "لإزالة دور: `/removeadmin @username`",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_roles_menu")]])
-        )
-    elif data == "admin_broadcast_button":
-        await query.edit_message_text(
-            "لبث رسالة: `/broadcast <الرسالة>`",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_menu")]])
-        )
-    else:
-        logger.warning(f"Unhandled button callback data: {data}")
-        await query.answer("هذا الزر ليس له وظيفة محددة بعد.")
+    with open(thumbnail_path, 'rb') as f:
+        await context.bot.send_photo(chat_id=update.callback_query.from_user.id, photo=f, caption=os.path.basename(file_abs_path))
+
+@callback_route("popular_here")
+async def _cb_popular_here(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_ranked_files(update.callback_query, context, 'popular')
+
+@callback_route("recent_here")
+async def _cb_recent_here(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_ranked_files(update.callback_query, context, 'recent')
+
+# --- 5. أزرار القوائم العامة والإدارية ---
+
+@callback_route("main_menu")
+async def _cb_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await send_main_keyboard(update, context)
+
+@callback_route("admin_menu", permission='admin')
+async def _cb_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await send_admin_menu(update, context)
+
+@callback_route("admin_roles_menu", permission='super_admin')
+async def _cb_admin_roles_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await send_admin_roles_menu(update, context)
+
+@callback_route("my_role")
+async def _cb_my_role(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await my_role(update, context)
+
+@callback_route("contact_admin_btn")
+async def _cb_contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await update.callback_query.edit_message_text(
+        "للتواصل مع الإدارة، استخدم الأمر: `/contact_admin <رسالتك>`",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main_menu")]])
+    )
+
+@callback_route("admin_newfolder", permission='admin')
+async def _cb_admin_newfolder(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_folder_creation_menu(update, context, os.path.abspath(FILES_DIR))
+
+@callback_route("admin_stats_button", permission='admin')
+async def _cb_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_stats_from_button(update, context)
+
+@callback_route("admin_activity_button", permission='admin')
+async def _cb_admin_activity(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_usage_history(update, context)
+
+@callback_route("admin_usage_button", permission='admin')
+async def _cb_admin_usage(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await show_storage_usage(update, context)
+
+@callback_route("admin_list_admins_button", permission='super_admin')
+async def _cb_admin_list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await list_admins_from_button(update, context)
+
+# --- 6. الأزرار التي تعرض مساعدة نصية للأوامر ---
+
+@callback_route("admin_upload_info", permission='admin')
+async def _cb_admin_upload_info(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await update.callback_query.edit_message_text(
+        "لرفع ملف، قم بإرساله مباشرة إلى البوت في أي وقت وسيتم توجيهك.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_menu")]])
+    )
+
+@callback_route("admin_set_role", permission='super_admin')
+async def _cb_admin_set_role(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await update.callback_query.edit_message_text(
+        "لتعيين دور: `/addadmin @username <role>`",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_roles_menu")]])
+    )
+
+@callback_route("admin_remove_role", permission='super_admin')
+async def _cb_admin_remove_role(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await update.callback_query.edit_message_text(
+        "لإزالة دور: `/removeadmin @username`",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_roles_menu")]])
+    )
+
+@callback_route("admin_broadcast_button", permission='super_admin')
+async def _cb_admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, _arg) -> None:
+    await update.callback_query.edit_message_text(
+        "لبث رسالة: `/broadcast <الرسالة>`",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ عودة", callback_data="admin_menu")]])
+    )
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -904,41 +3152,153 @@ app = Flask(__name__)
 def hello():
     return "I am alive and the bot is running with PostgreSQL!"
 
+_application = None
+_bot_loop = None
+_webhook_stop = None
+
+@app.route('/telegram', methods=['POST'])
+def telegram_webhook():
+    """Receives updates in webhook mode and hands them to the bot's event loop."""
+    if _application is None or _bot_loop is None:
+        abort(503)
+    if not MULTI_REPLICA:
+        abort(404)
+    # بدون هذا التحقق يستطيع أي أحد إرسال Update مزوّر باسم الـ Super Admin
+    secret_header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(secret_header, WEBHOOK_SECRET):
+        abort(403)
+    update = Update.de_json(request.get_json(force=True), _application.bot)
+    asyncio.run_coroutine_threadsafe(_application.update_queue.put(update), _bot_loop)
+    return "ok"
+
+_background_tasks = []
+
+async def run_periodically(interval: float, func, name: str) -> None:
+    """Runs an async maintenance function every `interval` seconds until cancelled."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception as e:
+            logger.error(f"Background task '{name}' failed: {e}")
+
+async def on_startup(application: Application) -> None:
+    """Starts the background maintenance tasks once the bot's event loop is running."""
+    global _job_wakeup
+    _job_wakeup = asyncio.Event()
+    for worker_no in range(JOB_WORKERS):
+        _background_tasks.append(asyncio.create_task(job_worker(application.bot, worker_no)))
+    _background_tasks.append(asyncio.create_task(run_periodically(60, requeue_stale_jobs, "stale job requeue")))
+    _background_tasks.append(asyncio.create_task(run_periodically(STATS_FLUSH_INTERVAL, flush_file_stats, "file stats flush")))
+    _background_tasks.append(asyncio.create_task(run_periodically(ACTIVITY_FLUSH_INTERVAL, flush_last_seen, "last_seen flush")))
+    _background_tasks.append(asyncio.create_task(run_periodically(STATS_FLUSH_INTERVAL, flush_usage_rollups, "usage rollup flush")))
+    _background_tasks.append(asyncio.create_task(backfill_file_metadata()))
+    _background_tasks.append(asyncio.create_task(run_periodically(RETENTION_SWEEP_INTERVAL, sweep_retention, "retention sweep")))
+    if MULTI_REPLICA:
+        _background_tasks.append(asyncio.create_task(listen_for_cache_invalidations()))
+
+async def on_shutdown(application: Application) -> None:
+    """Stops background tasks and flushes whatever is still buffered in memory."""
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await flush_file_stats()
+    await flush_last_seen()
+    await flush_usage_rollups()
+    shutdown_metadata_pool()
+
+async def serve_webhook(application: Application) -> None:
+    """Webhook counterpart of run_polling: updates arrive through the Flask /telegram route."""
+    global _webhook_stop
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET could not be set; refusing to accept unauthenticated webhook updates")
+    _webhook_stop = asyncio.Event()
+    await application.initialize()
+    await on_startup(application)
+    await application.bot.set_webhook(url=f"{WEBHOOK_URL}/telegram", secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=Update.ALL_TYPES)
+    await application.start()
+    logger.info(f"Bot is receiving updates via webhook at {WEBHOOK_URL}/telegram")
+    try:
+        await _webhook_stop.wait()
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+def request_bot_stop() -> None:
+    """Asks the bot thread to stop gracefully so buffered counters are flushed (thread-safe)."""
+    if _application is None or _bot_loop is None:
+        return
+    if MULTI_REPLICA:
+        _bot_loop.call_soon_threadsafe(_webhook_stop.set)
+    else:
+        _bot_loop.call_soon_threadsafe(_application.stop_running)
+
 def run_bot():
-    
+    global _application, _bot_loop
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    _bot_loop = loop
     
     """Contains the bot's setup and polling logic."""
     setup_database()  # Run the new PostgreSQL setup
-    application = Application.builder().token(TOKEN).build()
+    builder = Application.builder().token(TOKEN).post_init(on_startup).post_stop(on_shutdown)
+    if LOCAL_BOT_API:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot").local_mode(True)
+        logger.info(f"Using local Bot API server at {BOT_API_URL}")
+    application = builder.build()
+    _application = application
     
     # --- Register all handlers ---
+    if MULTI_REPLICA:
+        # Conversation state lives in Postgres so any replica can handle the next update
+        application.add_handler(TypeHandler(Update, load_shared_user_data), group=-2)
+        application.add_handler(TypeHandler(Update, save_shared_user_data), group=100)
+    # Bind update_id/user_id to every log record emitted while handling the update
+    application.add_handler(TypeHandler(Update, bind_log_context), group=-3)
+    # Activity tracking runs before every other handler and never blocks them
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
+    # Every command, message and button handler is wrapped so its logs carry a `handler` field and its duration
     # General Commands
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("myrole", my_role))
-    application.add_handler(CommandHandler("contact_admin", contact_admin))
+    application.add_handler(CommandHandler("start", logged_handler(start)))
+    application.add_handler(CommandHandler("myrole", logged_handler(my_role)))
+    application.add_handler(CommandHandler("contact_admin", logged_handler(contact_admin)))
     # Admin Commands
-    application.add_handler(CommandHandler("newfolder", new_folder))
-    application.add_handler(CommandHandler("delete", delete_item)) # Simplified handler
-    application.add_handler(CommandHandler("stats", show_stats_from_button)) # Map to button version
+    application.add_handler(CommandHandler("newfolder", logged_handler(new_folder)))
+    application.add_handler(CommandHandler("delete", logged_handler(delete_item))) # Simplified handler
+    application.add_handler(CommandHandler("stats", logged_handler(show_stats_from_button))) # Map to button version
+    application.add_handler(CommandHandler("routestats", logged_handler(show_route_stats)))
+    application.add_handler(CommandHandler("jobs", logged_handler(list_jobs)))
+    application.add_handler(CommandHandler("usage", logged_handler(show_storage_usage)))
+    application.add_handler(CommandHandler("retention", logged_handler(manage_retention)))
+    application.add_handler(CommandHandler("activity", logged_handler(show_usage_history)))
     # Super Admin Commands
-    application.add_handler(CommandHandler("addadmin", add_admin))
-    application.add_handler(CommandHandler("removeadmin", remove_admin))
-    application.add_handler(CommandHandler("listadmins", list_admins_from_button)) # Map to button version
-    application.add_handler(CommandHandler("broadcast", broadcast_message))
+    application.add_handler(CommandHandler("addadmin", logged_handler(add_admin)))
+    application.add_handler(CommandHandler("removeadmin", logged_handler(remove_admin)))
+    application.add_handler(CommandHandler("listadmins", logged_handler(list_admins_from_button))) # Map to button version
+    application.add_handler(CommandHandler("broadcast", logged_handler(broadcast_message)))
+    application.add_handler(CommandHandler("broadcast_active", logged_handler(broadcast_active)))
+    application.add_handler(CommandHandler("setquota", logged_handler(set_quota)))
+    application.add_handler(CommandHandler("loglevel", logged_handler(change_log_level)))
+    application.add_handler(CommandHandler("import", logged_handler(import_tree)))
 
     # Media and Text Handlers
     application.add_handler(MessageHandler(
-        (filters.Document.ALL | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND, handle_media_upload))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_message_handler))
+        (filters.Document.ALL | filters.PHOTO | filters.VIDEO) & ~filters.COMMAND, logged_handler(handle_media_upload)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, logged_handler(text_message_handler)))
 
     # Callback Query Handler for all buttons
-    application.add_handler(CallbackQueryHandler(handle_button_press))
+    application.add_handler(CallbackQueryHandler(logged_handler(handle_button_press)))
 
     # Error Handler
     application.add_error_handler(error_handler)
 
+    if MULTI_REPLICA:
+        loop.run_until_complete(serve_webhook(application))
+        return
+
     logger.info("Bot is starting polling with PostgreSQL backend... okkkkk")
     application.run_polling(stop_signals=None)
 
@@ -947,13 +3307,24 @@ def main():
     bot_thread = threading.Thread(target=run_bot)
     bot_thread.daemon = True
     bot_thread.start()
+
+    def handle_sigterm(signum, frame):
+        # Replicas are stopped and started routinely when scaling; give the bot a chance to flush
+        logger.info("SIGTERM received, stopping the bot...")
+        request_bot_stop()
+        bot_thread.join(timeout=25)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
     
     port = int(os.environ.get('PORT', 8080))
     logger.info(f"Flask web server starting on port {port}...")
     app.run(host='0.0.0.0', port=port)
 
 if __name__ == '__main__':
-    if not all([TOKEN, DATABASE_URL, SUPER_ADMIN_ID]):
+    if len(sys.argv) > 1 and sys.argv[1] == 'import':
+        run_import_cli(sys.argv[2:])
+    elif not all([TOKEN, DATABASE_URL, SUPER_ADMIN_ID]):
         logger.critical("FATAL: Missing one or more required environment variables (TELEGRAM_TOKEN, DATABASE_URL, SUPER_ADMIN_ID).")
     else:
         main()